@@ -0,0 +1,99 @@
+import argparse
+import os
+import time
+import torch
+from transformers import AutoModelForCausalLM
+from importlib.metadata import version
+
+from lib.sparse import sparsify_model, load_sparse, SPARSE_WEIGHTS_NAME
+
+print('torch', version('torch'))
+print('transformers', version('transformers'))
+
+DTYPES = {"float32": torch.float32, "bfloat16": torch.bfloat16, "float16": torch.float16}
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+# Median prefill latency and median per-token decode latency over the repeats, in seconds
+@torch.no_grad()
+def measure(model, batch_size, seqlen, decode_tokens, repeats, device):
+    vocab_size = model.config.vocab_size
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(0, vocab_size, (batch_size, seqlen), generator=generator).to(device)
+    prefill_times, decode_times = [], []
+    for r in range(repeats + 1):  ## the first run warms up and is discarded
+        sync(device)
+        start = time.perf_counter()
+        out = model(input_ids, use_cache=True)
+        sync(device)
+        prefill = time.perf_counter() - start
+        past_key_values = out.past_key_values
+        next_ids = out.logits[:, -1:].argmax(dim=-1)
+        start = time.perf_counter()
+        for _ in range(decode_tokens):
+            out = model(next_ids, past_key_values=past_key_values, use_cache=True)
+            past_key_values = out.past_key_values
+            next_ids = out.logits[:, -1:].argmax(dim=-1)
+        sync(device)
+        decode = (time.perf_counter() - start) / max(decode_tokens, 1)
+        if r > 0:
+            prefill_times.append(prefill)
+            decode_times.append(decode)
+    return sorted(prefill_times)[len(prefill_times) // 2], sorted(decode_times)[len(decode_times) // 2]
+
+def run(model, args, device):
+    results = {}
+    for batch_size in args.batch_sizes:
+        for seqlen in args.seqlens:
+            results[(batch_size, seqlen)] = measure(model, batch_size, seqlen, args.decode_tokens, args.repeats, device)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, help='Pruned model saved with --save_model (dense or sparse format)')
+    parser.add_argument('--cache_dir', default="llm_weights", type=str)
+    parser.add_argument('--sparsity_type', type=str, default="unstructured", choices=["unstructured", "4:8", "2:4"], help='CSRLinear for unstructured sparsity, NMLinear for n:m.')
+    parser.add_argument('--device', type=str, default="cpu", help='Device to benchmark on.')
+    parser.add_argument('--dtype', type=str, default="float32", choices=list(DTYPES), help='Weight and activation dtype (CPU sparse kernels need float32).')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch.set_num_threads for CPU runs.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--seqlens', type=int, nargs='+', default=[128, 512, 2048], help='Prompt lengths for prefill.')
+    parser.add_argument('--decode_tokens', type=int, default=32, help='Tokens generated after each prefill.')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device)
+    dtype = DTYPES[args.dtype]
+
+    print(f"loading llm model {args.model}")
+    start = time.perf_counter()
+    if os.path.exists(os.path.join(args.model, SPARSE_WEIGHTS_NAME)):
+        model = load_sparse(args.model, dtype)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=dtype, cache_dir=args.cache_dir, low_cpu_mem_usage=True)
+    print(f"loaded in {time.perf_counter() - start:.1f}s")
+    model.to(device)
+    model.eval()
+
+    print("dense baseline")
+    dense = run(model, args, device)
+    print(f"swapping linear layers for {args.sparsity_type} sparse modules")
+    sparsify_model(model, args.sparsity_type)
+    print("sparse")
+    sparse = run(model, args, device)
+
+    print("batch_size\tseqlen\tdense_prefill_ms\tsparse_prefill_ms\tprefill_speedup\tdense_prefill_tok/s\tsparse_prefill_tok/s\tdense_decode_ms\tsparse_decode_ms\tdecode_speedup\tdense_decode_tok/s\tsparse_decode_tok/s")
+    for (batch_size, seqlen), (dense_prefill, dense_decode) in dense.items():
+        sparse_prefill, sparse_decode = sparse[(batch_size, seqlen)]
+        print(f"{batch_size}\t{seqlen}\t"
+              f"{dense_prefill * 1e3:.1f}\t{sparse_prefill * 1e3:.1f}\t{dense_prefill / sparse_prefill:.2f}\t"
+              f"{batch_size * seqlen / dense_prefill:.0f}\t{batch_size * seqlen / sparse_prefill:.0f}\t"
+              f"{dense_decode * 1e3:.1f}\t{sparse_decode * 1e3:.1f}\t{dense_decode / sparse_decode:.2f}\t"
+              f"{batch_size / dense_decode:.0f}\t{batch_size / sparse_decode:.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,20 @@ import random
 from transformers import AutoTokenizer, AutoModelForCausalLM, LlamaTokenizer
 from transformers import AutoModelForVision2Seq, AutoProcessor
 from importlib.metadata import version
-# from transformers import AdamW
-from torch.optim import AdamW
 from datasets import load_dataset
 import torch.nn as nn 
+import torch.nn.functional as F
+import torch.distributed as dist
 from tqdm import tqdm
 import argparse
 import os
+import sys
 from PIL import Image
 from lib.prune import get_lm_layers
+from lib.gradients import save_gradients, encode_log8, decode_log8
+from lib.mask import row_mask
+from lib.data import cached_loader, sample_documents
+from functools import partial
 
 print('torch', version('torch'))
 print('transformers', version('transformers'))
@@ -72,7 +77,7 @@ def get_wikitext2(nsamples, seed, seqlen, tokenizer):
     return trainloader, testenc
 
 # Load and process c4 dataset
-def get_c4(nsamples, seed, seqlen, tokenizer):
+def get_c4(nsamples, seed, seqlen, tokenizer, tokenize_workers=None):
     # Load train and validation datasets
     print("trying to load allenai-c4 dataset........")
     traindata = load_dataset('allenai/c4', data_files={'train': 'en/c4-train.00000-of-01024.json.gz'}, split='train')
@@ -81,15 +86,7 @@ def get_c4(nsamples, seed, seqlen, tokenizer):
     # Generate samples from training set
     random.seed(seed)
     trainloader = []
-    for _ in range(nsamples):
-        while True:
-            i = random.randint(0, len(traindata) - 1)
-            trainenc = tokenizer(traindata[i]['text'], return_tensors='pt')
-            if trainenc.input_ids.shape[1] > seqlen:
-                break
-        i = random.randint(0, trainenc.input_ids.shape[1] - seqlen - 1)
-        j = i + seqlen
-        inp = trainenc.input_ids[:, i:j]
+    for inp, _ in sample_documents(traindata, nsamples, seqlen, tokenizer, tokenize_workers):
         tar = inp.clone()
         # tar[:, :-1] = -100
         trainloader.append((inp, tar))
@@ -116,22 +113,23 @@ def get_vqa(nsamples, seed, seqlen, tokenizer):
     return trainloader, None
 
 # Function to select the appropriate loader based on dataset name
-def get_loaders(name, nsamples=128, seed=0, seqlen=2048, tokenizer=None):
+# (these loaders do not truncate to model_max_length, so their cache entries are kept apart from lib/data.py's)
+def get_loaders(name, nsamples=128, seed=0, seqlen=2048, tokenizer=None, cache_dir=None, tokenize_workers=None):
     if 'wikitext2' in name:
-        return get_wikitext2(nsamples, seed, seqlen, tokenizer)
+        return cached_loader(get_wikitext2, 'wikitext2_untruncated', nsamples, seed, seqlen, tokenizer, cache_dir)
     if "c4" in name:
-        return get_c4(nsamples, seed, seqlen, tokenizer)
+        return cached_loader(partial(get_c4, tokenize_workers=tokenize_workers), 'c4_untruncated', nsamples, seed, seqlen, tokenizer, cache_dir)
     if "qwen2.5-vl" in name.lower() or "vl" in name.lower():
         return get_vqa(nsamples, seed, seqlen, tokenizer)
 
-def get_llm(model, cache_dir="llm_weights"):
+def get_llm(model, cache_dir="llm_weights", device_map="auto"):
     if any(x in model.lower() for x in ["vl", "vision", "llava"]):
         model = AutoModelForVision2Seq.from_pretrained(
             model,
             torch_dtype=torch.float16,
             cache_dir=cache_dir,
             low_cpu_mem_usage=True,
-            device_map="auto",
+            device_map=device_map,
             trust_remote_code=True
         )
         print("printing gpu allocation for all the layers (VLM)")
@@ -145,7 +143,7 @@ def get_llm(model, cache_dir="llm_weights"):
             torch_dtype=torch.float16, 
             cache_dir=cache_dir, 
             low_cpu_mem_usage=True, 
-            device_map="auto"
+            device_map=device_map
         )
         print("printing gpu allocation for all the layers")
         print(model.hf_device_map)
@@ -153,14 +151,48 @@ def get_llm(model, cache_dir="llm_weights"):
         model.seqlen = getattr(model.config, 'max_position_embeddings', 2048)
         return model
 
+def check_encoding(model, gradients, sparsity_ratio=0.5):
+    """
+    Compare the unstructured |W| * |G| masks obtained from the fp16 gradients with the ones
+    obtained after a log8 encode/decode round trip.
+    """
+    layers = get_lm_layers(model)
+    agreements = []
+    for i in range(len(layers)):
+        subset = find_layers(layers[i])
+        for name in subset:
+            G = torch.abs(gradients[f"{name}_layer_{i}"])
+            W = torch.abs(subset[name].weight.data).cpu().to(dtype=torch.float32)
+            num_prune = int(W.shape[1] * sparsity_ratio)
+            W_mask = row_mask(W * G.to(dtype=torch.float32), num_prune)
+            W_mask_log8 = row_mask(W * decode_log8(*encode_log8(G)).to(dtype=torch.float32), num_prune)
+            agreements.append((W_mask == W_mask_log8).to(dtype=torch.float32).mean().item())
+    print(f"log8 mask agreement at sparsity {sparsity_ratio}: mean {np.mean(agreements):.6f}, min {np.min(agreements):.6f}")
+
+def per_sample_loss(model, input_ids, labels):
+    """
+    Sum over the batch of each sample's mean next-token loss, so that the gradient of every
+    sample is the one a batch-size-1 backward would produce.
+    """
+    logits = model(input_ids=input_ids).logits
+    shift_logits = logits[:, :-1, :].to(dtype=torch.float32)
+    shift_labels = labels[:, 1:].to(device=shift_logits.device)
+    loss = F.cross_entropy(shift_logits.reshape(-1, shift_logits.shape[-1]), shift_labels.reshape(-1), reduction="none")
+    return loss.reshape(input_ids.shape[0], -1).mean(dim=1).sum()
+
 class gradient_computation:
-    def __init__(self, model, scale):
+    def __init__(self, model, scale, accumulator_device=None):
         self.model = model
+        self.accumulator_device = accumulator_device
         self.gradients_l1 = dict()
         self.gradients_l2 = dict()
         self.nsample = 0
         self.scale = scale
         self.device = torch.device("cpu") 
+        self.weights = dict()
+        self.modules = dict()
+        self.handles = []
+        self.received = set()
         self.gradients_init()
 
     def gradients_init(self):
@@ -170,29 +202,129 @@ class gradient_computation:
             subset = find_layers(layer)
             for name in subset:
                 indexed_name = f"{name}_layer_{i}"
-                self.gradients_l1[indexed_name] = torch.zeros_like(subset[name].weight, dtype=torch.float16, device=self.device)
-                self.gradients_l2[indexed_name] = torch.zeros_like(subset[name].weight, dtype=torch.float32, device=self.device)
-    
+                weight = subset[name].weight
+                self.weights[indexed_name] = weight
+                self.modules[indexed_name] = subset[name]
+                ## fp32 accumulators next to the weight (or on accumulator_device), folded into by a hook as soon as its gradient is ready
+                self.gradients_l1[indexed_name] = torch.zeros_like(weight, dtype=torch.float32, device=self.accumulator_device)
+                self.gradients_l2[indexed_name] = torch.zeros_like(weight, dtype=torch.float32, device=self.accumulator_device)
+                self.handles.append(weight.register_post_accumulate_grad_hook(self.accumulate_hook(indexed_name)))
+
+    def freeze_non_prunable(self):
+        """
+        Keep requires_grad only on the tracked Linear weights, so backward allocates no gradients
+        for embeddings, lm_head, norms or a vision tower.
+        """
+        for param in self.model.parameters():
+            param.requires_grad_(False)
+        for weight in self.weights.values():
+            weight.requires_grad_(True)
+
+    def enable_per_sample(self):
+        """
+        Form the per-sample weight gradient of every tracked Linear from its captured input and
+        output gradient, so several samples can share one forward/backward. The weights are frozen
+        and the weight hooks removed, since autograd would only give the batch-summed gradient.
+        """
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+        for param in self.model.parameters():
+            param.requires_grad_(False)
+        ## gradients still have to flow through the activations to every Linear output
+        self.model.enable_input_require_grads()
+        for indexed_name, module in self.modules.items():
+            self.handles.append(module.register_forward_hook(self.capture_hook(indexed_name)))
+
+    def capture_hook(self, indexed_name):
+        def hook(module, inp, out):
+            x = inp[0].detach()
+            def backward_hook(grad_out):
+                for b in range(x.shape[0]):
+                    ## dL_b/dW = grad_out_b^T x_b, summed over the tokens of sample b
+                    grad = grad_out[b].reshape(-1, grad_out.shape[-1]).t().to(dtype=torch.float32) @ x[b].reshape(-1, x.shape[-1]).to(dtype=torch.float32)
+                    self.accumulate(indexed_name, grad)
+            if out.requires_grad:
+                out.register_hook(backward_hook)
+        return hook
+
+    def accumulate(self, indexed_name, grad):
+        grad = grad.to(device=self.gradients_l1[indexed_name].device, dtype=torch.float32) * self.scale
+        self.gradients_l1[indexed_name] += torch.abs(grad)
+        self.gradients_l2[indexed_name] += grad ** 2
+        self.received.add(indexed_name)
+
+    def accumulate_hook(self, indexed_name):
+        def hook(param):
+            self.accumulate(indexed_name, param.grad)
+            param.grad = None  ## the gradient is not needed once folded in
+        return hook
+
     def update_gradient(self, model, nsample):
-        assert nsample - self.nsample == 1, "number of samples must be incremented by 1"
-        layers = get_lm_layers(model)
-        for i in tqdm(range(len(layers)), desc=f"updating the gradient of sample no: {self.nsample}"):
-            layer = layers[i]
-            subset = find_layers(layer)
-            for name in subset:
-                indexed_name = f"{name}_layer_{i}"
-                if subset[name].weight.grad is None:
-                    print(f"Error: {name} has none gradient")
-                if subset[name].weight.grad is not None:
-                    assert subset[name].weight.requires_grad == True, f"Required grad must be true ( {name}: {subset[name].weight.requires_grad})"
-                    grad = subset[name].weight.grad.detach().clone().to(dtype=torch.float32)  # Cast to float32
-                    all_zero = (torch.abs(grad)==0).all()
-                    assert int(all_zero) == 0, f"all the elements in the tensor are zero.: {all_zero}"
-                    assert self.gradients_l1[indexed_name].shape == grad.shape, "shape mismatch"
-                    self.gradients_l1[indexed_name] = self.gradients_l1[indexed_name] + torch.abs(grad*self.scale).to(device=self.device).to(dtype=torch.float16)
-                    self.gradients_l2[indexed_name] = self.gradients_l2[indexed_name] + torch.abs((grad*self.scale)**2).to(device=self.device)
+        assert nsample > self.nsample, "number of samples must be incremented"
+        for indexed_name in self.gradients_l1:
+            if indexed_name not in self.received:
+                print(f"Error: {indexed_name} has none gradient")
+        self.received = set()
         self.nsample = nsample
 
+    def all_reduce(self):
+        """
+        Sum the accumulators and sample counts of all data-parallel ranks.
+        """
+        for name in self.gradients_l1:
+            dist.all_reduce(self.gradients_l1[name])
+            dist.all_reduce(self.gradients_l2[name])
+        nsample = torch.tensor([self.nsample])
+        dist.all_reduce(nsample)
+        self.nsample = int(nsample.item())
+
+    def save_checkpoint(self, path):
+        """
+        Atomically write the accumulators, the sample count and the RNG states to path.
+        """
+        state = {
+            "gradients_l1": {name: g.cpu() for name, g in self.gradients_l1.items()},
+            "gradients_l2": {name: g.cpu() for name, g in self.gradients_l2.items()},
+            "nsample": self.nsample,
+            "rng": {
+                "python": random.getstate(),
+                "numpy": np.random.get_state(),
+                "torch": torch.random.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            },
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load_checkpoint(self, path):
+        state = torch.load(path, map_location=torch.device('cpu'), weights_only=False)
+        for name in self.gradients_l1:
+            self.gradients_l1[name].copy_(state["gradients_l1"][name])
+            self.gradients_l2[name].copy_(state["gradients_l2"][name])
+        self.nsample = state["nsample"]
+        random.setstate(state["rng"]["python"])
+        np.random.set_state(state["rng"]["numpy"])
+        torch.random.set_rng_state(state["rng"]["torch"])
+        if state["rng"]["cuda"] is not None:
+            torch.cuda.set_rng_state_all(state["rng"]["cuda"])
+
+    def finalize(self):
+        """
+        Remove the hooks and move the accumulators to the CPU once, l1 in fp16 and l2 in fp32.
+        """
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+        for indexed_name in self.gradients_l1:
+            assert bool(self.gradients_l1[indexed_name].any()), f"all the elements in the gradient of {indexed_name} are zero"
+            self.gradients_l1[indexed_name] = self.gradients_l1[indexed_name].to(device=self.device, dtype=torch.float16)
+            self.gradients_l2[indexed_name] = self.gradients_l2[indexed_name].to(device=self.device)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -202,12 +334,42 @@ if __name__ == "__main__":
     parser.add_argument('--model', type=str, help='model to used') ## change
     parser.add_argument('--cache_dir', type=str, default="./llm_weights", help='Cache dir') 
     parser.add_argument('--gradient_path', type=str, default="./gradients", help='gradient path') 
+    parser.add_argument('--data_cache_dir', type=str, default=None, help='directory of the tokenized calibration cache (default: $GBLM_DATA_CACHE, no caching if unset)')
+    parser.add_argument('--tokenize_workers', type=int, default=None, help='processes for batched c4 tokenization with a slow tokenizer (default: min(8, cpu count))')
+    parser.add_argument('--prunable_only', action='store_true', help='freeze every parameter except the decoder-layer Linear weights whose gradients are accumulated')
+    parser.add_argument('--gradient_checkpointing', action='store_true', help='recompute decoder-layer activations in backward instead of keeping them')
+    parser.add_argument('--accumulator_device', type=str, default=None, help='device of the gradient accumulators, e.g. cpu to offload each gradient as soon as it is produced (default: next to the weight)')
+    parser.add_argument('--max_seqlen', type=int, default=None, help='cap on the calibration sequence length, independent of max_position_embeddings')
+    parser.add_argument('--grad_batch_size', type=int, default=1, help='samples per forward/backward; above 1, per-sample gradients are formed from captured Linear inputs and output gradients')
+    parser.add_argument('--checkpoint_every', type=int, default=0, help='write a resumable checkpoint every this many samples (0 disables)')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint of an interrupted run')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads per process (0: all cores, split between the local ranks under torchrun)')
+    parser.add_argument('--save_format', type=str, default="sharded", choices=["sharded", "pth"], help='per-layer safetensors shards with an index, or one monolithic .pth per norm')
+    parser.add_argument('--encoding', type=str, default="fp16", choices=["fp16", "log8"], help='encoding of the sharded gradient magnitudes, log8 is 8-bit log-scale with per-row scales')
+    parser.add_argument('--check_encoding', action='store_true', help='with --encoding log8, report how much the encoding changes the gradient pruning masks')
     args = parser.parse_args()
+    if args.encoding == "log8" and args.save_format != "sharded":
+        parser.error("--encoding log8 is only written by --save_format sharded")
+    if args.check_encoding and args.encoding != "log8":
+        parser.error("--check_encoding compares against the log8 encoding, pass --encoding log8")
     print(f"Obtaining gradients for no of samples {args.nsamples}, scale {args.scale}")
     
+    # Data-parallel mode under torchrun: every rank keeps a CPU replica and handles a shard of the samples
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    rank = int(os.environ.get("RANK", 0))
+    if world_size > 1:
+        dist.init_process_group("gloo")
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+        torch.set_num_threads(args.num_threads if args.num_threads > 0 else max(1, os.cpu_count() // local_world_size))
+        print(f"rank {rank} of {world_size}, {torch.get_num_threads()} threads")
+    elif args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
     model_args = args.model
     cache_dir_args = args.cache_dir
-    model = get_llm(model_args, cache_dir_args)
+    model = get_llm(model_args, cache_dir_args, device_map={"": "cpu"} if world_size > 1 else "auto")
+    if args.max_seqlen is not None:
+        model.seqlen = min(model.seqlen, args.max_seqlen)
     tokenizer = AutoTokenizer.from_pretrained(model_args, use_fast=False)
     # if args.llama_version == 2:
     #     tokenizer = AutoTokenizer.from_pretrained(model_args, use_fast=False)
@@ -233,35 +395,76 @@ if __name__ == "__main__":
     seed=0
     # Use the model's actual sequence length instead of hardcoding 2048
     seqlen = getattr(model, 'seqlen', 2048)
-    dataloader, _ = get_loaders("c4",nsamples=nsamples,seed=seed,seqlen=seqlen,tokenizer=tokenizer)
+    dataloader, _ = get_loaders("c4",nsamples=nsamples,seed=seed,seqlen=seqlen,tokenizer=tokenizer,cache_dir=args.data_cache_dir,tokenize_workers=args.tokenize_workers)
+    dataloader = dataloader[rank::world_size]
     print("dataset loading complete")
-    optimizer = AdamW(model.parameters(), lr=0.01, eps=0.01)
-    optimizer.zero_grad()
     scale = args.scale
-    grad_up = gradient_computation(model, scale)
-    nsample = 0
+    grad_up = gradient_computation(model, scale, args.accumulator_device)
+    if args.prunable_only:
+        grad_up.freeze_non_prunable()
+    if args.grad_batch_size > 1:
+        assert not args.gradient_checkpointing, "per-sample micro-batching captures Linear inputs in forward and does not support checkpointing"
+        grad_up.enable_per_sample()
+    model.zero_grad(set_to_none=True)
+    model_name = os.path.basename(args.model)
+    if not os.path.exists(f'{args.gradient_path}/{args.model_with_version}'):
+        os.makedirs(f'{args.gradient_path}/{args.model_with_version}')
+    checkpoint_path = f'{args.gradient_path}/{args.model_with_version}/checkpoint_{model_name}.pt'
+    if world_size > 1:
+        checkpoint_path = f'{args.gradient_path}/{args.model_with_version}/checkpoint_{model_name}_rank{rank}.pt'
+    if args.resume and os.path.exists(checkpoint_path):
+        grad_up.load_checkpoint(checkpoint_path)
+        print(f"resuming from {checkpoint_path} after {grad_up.nsample} samples")
+    nsample = grad_up.nsample
     model.train()
-    for input_ids, labels in dataloader:
-        nsample+=1
+    if args.gradient_checkpointing:
+        ## non-reentrant checkpointing also works when the embeddings are frozen by --prunable_only
+        model.config.use_cache = False
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    for j in range(nsample, len(dataloader), args.grad_batch_size):
+        batch = dataloader[j:j+args.grad_batch_size]
+        nsample+=len(batch)
         print("making gradient computation on sample: ", nsample)
-        input_ids = input_ids.to(device)
-        labels = labels.to(device)
-        outputs = model(input_ids=input_ids, labels=labels) 
-        loss = outputs.loss
+        input_ids = torch.cat([b[0] for b in batch]).to(device)
+        labels = torch.cat([b[1] for b in batch]).to(device)
+        if args.grad_batch_size > 1:
+            loss = per_sample_loss(model, input_ids, labels)
+        else:
+            outputs = model(input_ids=input_ids, labels=labels) 
+            loss = outputs.loss
         print("Printing the loss:", loss)
         loss.backward()
         grad_up.update_gradient(model, nsample)
-        optimizer.zero_grad()
+        model.zero_grad(set_to_none=True)
+        if args.checkpoint_every > 0 and nsample // args.checkpoint_every > (nsample - len(batch)) // args.checkpoint_every:
+            grad_up.save_checkpoint(checkpoint_path)
     print("Done")
+    if world_size > 1:
+        grad_up.all_reduce()
+    grad_up.finalize()
     gradients_l2 = grad_up.gradients_l2
 
+    if rank != 0:
+        dist.destroy_process_group()
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        sys.exit(0)
+
     for name in gradients_l2:
         grad_sqrt = torch.sqrt(gradients_l2[name])
         gradients_l2[name] = grad_sqrt.to(dtype=torch.float16)
-    model_name = os.path.basename(args.model)
-    if not os.path.exists(f'{args.gradient_path}/{args.model_with_version}'):
-        os.makedirs(f'{args.gradient_path}/{args.model_with_version}')
-    with open(f'{args.gradient_path}/{args.model_with_version}/gradients_aggregrate_norm_l2_model_{model_name}.pth', 'wb') as f:
-        torch.save(gradients_l2, f)
-    with open(f'{args.gradient_path}/{args.model_with_version}/gradients_aggregrate_norm_l1_model_{model_name}.pth', 'wb') as f:
-        torch.save(grad_up.gradients_l1, f)
\ No newline at end of file
+    if args.check_encoding:
+        check_encoding(model, grad_up.gradients_l1)
+        check_encoding(model, gradients_l2)
+    if args.save_format == "sharded":
+        save_gradients(gradients_l2, f'{args.gradient_path}/{args.model_with_version}/gradients_aggregrate_norm_l2_model_{model_name}', args.encoding)
+        save_gradients(grad_up.gradients_l1, f'{args.gradient_path}/{args.model_with_version}/gradients_aggregrate_norm_l1_model_{model_name}', args.encoding)
+    else:
+        with open(f'{args.gradient_path}/{args.model_with_version}/gradients_aggregrate_norm_l2_model_{model_name}.pth', 'wb') as f:
+            torch.save(gradients_l2, f)
+        with open(f'{args.gradient_path}/{args.model_with_version}/gradients_aggregrate_norm_l1_model_{model_name}.pth', 'wb') as f:
+            torch.save(grad_up.gradients_l1, f)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if world_size > 1:
+        dist.destroy_process_group()
@@ -0,0 +1,85 @@
+#activations.py
+import math
+import os
+import tempfile
+import torch
+
+
+class QuantizedActivations:
+    """
+    Calibration activation buffer holding every hidden-state row in 8 bits with a per-token
+    scale. Indexing dequantizes to dtype and assignment quantizes, so the pruning loops use it
+    like the plain tensor buffers.
+    """
+
+    def __init__(self, shape, dtype, device, fmt="int8", store="memory", store_dir=None):
+        self.shape = torch.Size(shape)
+        self.dtype = dtype
+        self.fmt = fmt
+        ## fp8 codes are kept as raw bytes, the buffers only ever need to be zeroed and copied
+        storage_dtype = torch.int8 if fmt == "int8" else torch.uint8
+        self.data = alloc_activations(shape, storage_dtype, device, store, store_dir)
+        self.scale = alloc_activations(shape[:-1], torch.float32, device, store, store_dir)
+        self.qmax = 127.0 if fmt == "int8" else torch.finfo(torch.float8_e4m3fn).max
+
+    @property
+    def device(self):
+        return self.data.device
+
+    def to(self, device):
+        self.data = self.data.to(device)
+        self.scale = self.scale.to(device)
+        return self
+
+    def __getitem__(self, idx):
+        data = self.data[idx]
+        if self.fmt == "fp8":
+            data = data.view(torch.float8_e4m3fn)
+        return (data.to(torch.float32) * self.scale[idx].unsqueeze(-1)).to(self.dtype)
+
+    def __setitem__(self, idx, value):
+        value = value.to(device=self.data.device, dtype=torch.float32)
+        scale = (value.abs().amax(dim=-1) / self.qmax).clamp_(min=1e-12)
+        value = value / scale.unsqueeze(-1)
+        if self.fmt == "int8":
+            value = value.round_().clamp_(-self.qmax, self.qmax).to(torch.int8)
+        else:
+            value = value.to(torch.float8_e4m3fn).view(torch.uint8)
+        self.data[idx] = value
+        self.scale[idx] = scale
+
+
+def alloc_activations(shape, dtype, device, store="memory", store_dir=None, fmt="native"):
+    """
+    Allocate a zero-initialized buffer for calibration activations.
+
+    Args:
+        shape (tuple): Buffer shape, (nsamples, seqlen, hidden_size).
+        dtype (torch.dtype): Element type.
+        device (torch.device): Device of the buffer for the "memory" store.
+        store (str): "memory" for a regular tensor on device, "mmap" for a CPU tensor
+            backed by a memory-mapped file.
+        store_dir (str): Directory of the backing file for the "mmap" store, the system
+            temporary directory when None.
+        fmt (str): "native" to store dtype as is, "int8" or "fp8" for a QuantizedActivations
+            buffer on top of the same store.
+
+    Returns:
+        torch.Tensor: The buffer. An "mmap" buffer is indexed like any other CPU tensor and
+        only the pages that are touched are held in RAM.
+    """
+    if fmt != "native":
+        return QuantizedActivations(shape, dtype, device, fmt, store, store_dir)
+    if store == "memory":
+        return torch.zeros(shape, dtype=dtype, device=device)
+    if store_dir is not None:
+        os.makedirs(store_dir, exist_ok=True)
+    numel = math.prod(shape)
+    fd, path = tempfile.mkstemp(prefix="activations_", suffix=".bin", dir=store_dir)
+    ## sparse file, reads back as zeros until written
+    os.ftruncate(fd, numel * torch.empty((), dtype=dtype).element_size())
+    os.close(fd)
+    buffer = torch.from_file(path, shared=True, size=numel, dtype=dtype)
+    ## the mapping keeps the data alive, so the disk space goes away with the tensor
+    os.unlink(path)
+    return buffer.view(shape)
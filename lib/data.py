@@ -1,9 +1,15 @@
 # Code adapted from https://github.com/IST-DASLab/sparsegpt/blob/master/datautils.py
 #data.py
+import hashlib
+import json
+import os
+import shutil
 import numpy as np
 import random
 import torch
+import multiprocessing
 from datasets import load_dataset
+from functools import partial
 from torch.utils.data import TensorDataset
 
 # Set seed for reproducibility
@@ -45,11 +51,70 @@ def get_wikitext2(nsamples, seed, seqlen, tokenizer):
         trainloader.append((inp, attention_mask, tar))
     return trainloader, testenc
 
+_worker_tokenizer = None
+_worker_kwargs = None
+
+def _init_tokenize_worker(tokenizer, tokenize_kwargs):
+    global _worker_tokenizer, _worker_kwargs
+    _worker_tokenizer = tokenizer
+    _worker_kwargs = tokenize_kwargs
+
+def _tokenize_worker(text):
+    enc = _worker_tokenizer(text, **_worker_kwargs)
+    return enc['input_ids'], enc['attention_mask']
+
+# Draw nsamples windows of seqlen tokens from documents longer than seqlen, like the sequential
+# rejection loop (draw a document, tokenize it, redraw if too short) but tokenizing in batches.
+# Once a document is drawn, the next batch_size - 1 draws of the loop are peeked at by saving and
+# restoring the random state, and all of those documents are tokenized together; the loop then
+# replays the same draws, so the windows are identical to the sequential ones. Fast tokenizers
+# encode a batch in parallel themselves, slow ones are spread over a process pool.
+def sample_documents(traindata, nsamples, seqlen, tokenizer, tokenize_workers=None, batch_size=64, **tokenize_kwargs):
+    if tokenize_workers is None:
+        tokenize_workers = min(8, os.cpu_count() or 1)
+    pool = None
+    if not getattr(tokenizer, 'is_fast', False) and tokenize_workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(tokenize_workers, _init_tokenize_worker, (tokenizer, tokenize_kwargs))
+    encoded = {}
+
+    def encode(i):
+        if i not in encoded:
+            state = random.getstate()
+            candidates = [i] + [random.randint(0, len(traindata) - 1) for _ in range(batch_size - 1)]
+            random.setstate(state)
+            todo = [c for c in dict.fromkeys(candidates) if c not in encoded]
+            texts = traindata[todo]['text']
+            if pool is not None:
+                encs = pool.map(_tokenize_worker, texts, chunksize=max(1, len(texts) // (4 * tokenize_workers)))
+            else:
+                batch = tokenizer(texts, **tokenize_kwargs)
+                encs = zip(batch['input_ids'], batch['attention_mask'])
+            for c, (input_ids, attention_mask) in zip(todo, encs):
+                ## short documents are only ever rejected, keep their length alone
+                encoded[c] = (input_ids, attention_mask) if len(input_ids) > seqlen else len(input_ids)
+        return encoded[i]
+
+    try:
+        samples = []
+        for _ in range(nsamples):
+            while True:
+                i = random.randint(0, len(traindata) - 1)
+                enc = encode(i)
+                if not isinstance(enc, int):
+                    break
+            input_ids, attention_mask = enc
+            i = random.randint(0, len(input_ids) - seqlen - 1)
+            j = i + seqlen
+            samples.append((torch.tensor([input_ids[i:j]], dtype=torch.long), torch.tensor([attention_mask[i:j]], dtype=torch.long)))
+        return samples
+    finally:
+        if pool is not None:
+            pool.terminate()
+
 # Load and process c4 dataset
-def get_c4(nsamples, seed, seqlen, tokenizer):
-    # Load train and validation datasets
+def get_c4(nsamples, seed, seqlen, tokenizer, tokenize_workers=None):
+    # Load train dataset
     traindata = load_dataset('allenai/c4', data_files={'train': 'en/c4-train.00000-of-01024.json.gz'}, split='train', verification_mode='no_checks')
-    valdata = load_dataset('allenai/c4', data_files={'validation': 'en/c4-validation.00000-of-00008.json.gz'}, split='validation', verification_mode='no_checks')
 
     # Use max_length from tokenizer or fallback to seqlen
     max_length = getattr(tokenizer, 'model_max_length', seqlen)
@@ -57,31 +122,96 @@ def get_c4(nsamples, seed, seqlen, tokenizer):
     # Generate samples from training set
     random.seed(seed)
     trainloader = []
-    for _ in range(nsamples):
-        while True:
-            i = random.randint(0, len(traindata) - 1)
-            trainenc = tokenizer(traindata[i]['text'], return_tensors='pt', max_length=max_length, truncation=True)
-            if trainenc.input_ids.shape[1] > seqlen:
-                break
-        i = random.randint(0, trainenc.input_ids.shape[1] - seqlen - 1)
-        j = i + seqlen
-        inp = trainenc.input_ids[:, i:j]
-        attention_mask = trainenc.attention_mask[:, i:j] # Keep the corresponding mask slice
+    for inp, attention_mask in sample_documents(traindata, nsamples, seqlen, tokenizer, tokenize_workers, max_length=max_length, truncation=True):
         tar = inp.clone()
         # tar[:, :-1] = -100
         trainloader.append((inp, attention_mask, tar))
 
     # Prepare validation dataset
+    valenc = get_c4_validation(seqlen, tokenizer)
+    # return trainloader, valenc, data
+    return trainloader, valenc
+
+# Load and tokenize the c4 validation ids only, without the train shard and calibration samples
+def get_c4_validation(seqlen, tokenizer):
+    valdata = load_dataset('allenai/c4', data_files={'validation': 'en/c4-validation.00000-of-00008.json.gz'}, split='validation', verification_mode='no_checks')
+
+    # Use max_length from tokenizer or fallback to seqlen
+    max_length = getattr(tokenizer, 'model_max_length', seqlen)
+
     val_text = ' '.join(valdata[:1100]['text'])
     valenc = tokenizer(val_text, return_tensors='pt', max_length=max_length, truncation=True)
     valenc = valenc.input_ids[:, :(256 * seqlen)]
-    valenc = TokenizerWrapper(valenc)
-    # return trainloader, valenc, data
-    return trainloader, valenc
+    return TokenizerWrapper(valenc)
+
+# Hash of everything that decides the token ids produced by a tokenizer
+def tokenizer_fingerprint(tokenizer):
+    h = hashlib.sha1()
+    h.update(type(tokenizer).__name__.encode())
+    h.update(str(getattr(tokenizer, 'name_or_path', '')).encode())
+    h.update(str(getattr(tokenizer, 'model_max_length', '')).encode())
+    h.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    return h.hexdigest()[:16]
+
+# Location of the token cache entry of one loader call
+def token_cache_path(cache_dir, name, nsamples, seed, seqlen, tokenizer):
+    return os.path.join(cache_dir, f"{name}_n{nsamples}_seed{seed}_len{seqlen}_{tokenizer_fingerprint(tokenizer)}")
+
+# Store the token ids of a loader call as .npy files that can be memory-mapped
+def save_token_cache(path, trainloader, testenc):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'train_ids.npy'), torch.cat([sample[0] for sample in trainloader]).numpy())
+    with_mask = len(trainloader[0]) == 3
+    if with_mask:
+        np.save(os.path.join(tmp_path, 'train_mask.npy'), torch.cat([sample[1] for sample in trainloader]).numpy())
+    if testenc is not None:
+        np.save(os.path.join(tmp_path, 'test_ids.npy'), testenc.input_ids.numpy())
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'with_mask': with_mask, 'with_test': testenc is not None}, f)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another run filled the entry first
+        shutil.rmtree(tmp_path)
+
+# Rebuild the (trainloader, testenc) pair of a loader call from the token cache
+def load_token_cache(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    train_ids = np.load(os.path.join(path, 'train_ids.npy'), mmap_mode='r')
+    train_mask = np.load(os.path.join(path, 'train_mask.npy'), mmap_mode='r') if meta['with_mask'] else None
+    trainloader = []
+    for k in range(train_ids.shape[0]):
+        inp = torch.from_numpy(np.array(train_ids[k:k+1]))
+        tar = inp.clone()
+        if train_mask is not None:
+            trainloader.append((inp, torch.from_numpy(np.array(train_mask[k:k+1])), tar))
+        else:
+            trainloader.append((inp, tar))
+    testenc = None
+    if meta['with_test']:
+        testenc = TokenizerWrapper(torch.from_numpy(np.array(np.load(os.path.join(path, 'test_ids.npy'), mmap_mode='r'))))
+    return trainloader, testenc
+
+# Serve a loader call from the token cache in cache_dir (or $GBLM_DATA_CACHE), filling it on a miss
+def cached_loader(loader, name, nsamples, seed, seqlen, tokenizer, cache_dir=None):
+    cache_dir = cache_dir or os.environ.get('GBLM_DATA_CACHE')
+    if cache_dir is None:
+        return loader(nsamples, seed, seqlen, tokenizer)
+    path = token_cache_path(cache_dir, name, nsamples, seed, seqlen, tokenizer)
+    if os.path.isdir(path):
+        print(f"loading tokenized {name} from {path}")
+        return load_token_cache(path)
+    trainloader, testenc = loader(nsamples, seed, seqlen, tokenizer)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_token_cache(path, trainloader, testenc)
+    return trainloader, testenc
 
 # Function to select the appropriate loader based on dataset name
-def get_loaders(name, nsamples=128, seed=0, seqlen=2048, tokenizer=None):
+def get_loaders(name, nsamples=128, seed=0, seqlen=2048, tokenizer=None, cache_dir=None, tokenize_workers=None):
     if 'wikitext2' in name:
-        return get_wikitext2(nsamples, seed, seqlen, tokenizer)
+        return cached_loader(get_wikitext2, 'wikitext2', nsamples, seed, seqlen, tokenizer, cache_dir)
     if "c4" in name:
-        return get_c4(nsamples, seed, seqlen, tokenizer)
\ No newline at end of file
+        return cached_loader(partial(get_c4, tokenize_workers=tokenize_workers), 'c4', nsamples, seed, seqlen, tokenizer, cache_dir)
\ No newline at end of file
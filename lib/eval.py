@@ -1,40 +1,126 @@
 # Import necessary modules
+import math
 import time
+from contextlib import contextmanager
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 # Import get_loaders function from data module within the same directory
-from .data import get_loaders 
+from .data import get_loaders, get_c4_validation, tokenizer_fingerprint
+from .prune import get_lm_layers, prepare_calibration_input, layer_forward
+
+# Tokenized test sets already loaded by this process, keyed by dataset, seqlen and tokenizer
+_testenc_cache = {}
+
+# Function to get the tokenized test set of a dataset, tokenizing it at most once per process
+def get_testenc(dataset, seqlen, tokenizer, cache_dir=None):
+    key = (dataset, seqlen, tokenizer_fingerprint(tokenizer))
+    if key not in _testenc_cache:
+        if "c4" in dataset:
+            # c4 validation ids alone, without sampling calibration documents from the train shard
+            testenc = get_c4_validation(seqlen, tokenizer)
+        else:
+            # wikitext2 test split
+            _, testenc = get_loaders(
+                dataset, seed=0, seqlen=seqlen, tokenizer=tokenizer, cache_dir=cache_dir
+            )
+        _testenc_cache[key] = testenc.input_ids
+    return _testenc_cache[key]
 
 # Function to evaluate perplexity (ppl) on a specified model and tokenizer
-def eval_ppl(model, tokenizer, device=torch.device("cuda:0")):
-    # Set dataset
-    dataset = "wikitext2"
+def eval_ppl(model, tokenizer, device=torch.device("cuda:0"), cache_dir=None, datasets=("wikitext2",), bs=1, vocab_chunk=0, mode="full", store="memory", store_dir=None, tolerance=0, seed=0):
+    # Per dataset: perplexity and the number of test tokens it was computed from
+    results = {}
+    for dataset in datasets:
+        # Print status
+        print(f"evaluating on {dataset}")
+
+        # Get the test set
+        testenc = get_testenc(dataset, model.seqlen, tokenizer, cache_dir)
+
+        # Evaluate ppl in no grad context to avoid updating the model
+        with torch.no_grad():
+            if tolerance > 0:
+                ppl, _, _, tokens = eval_ppl_estimate(model, testenc, bs, device, vocab_chunk, tolerance, seed)
+            elif mode == "layerwise":
+                ppl = eval_ppl_layerwise(model, testenc, bs, device, vocab_chunk, store, store_dir)
+                tokens = (testenc.numel() // model.seqlen) * model.seqlen
+            else:
+                ppl = eval_ppl_wikitext(model, testenc, bs, device, vocab_chunk)
+                tokens = (testenc.numel() // model.seqlen) * model.seqlen
+        results[dataset] = {"ppl": ppl, "tokens": tokens}
+    return results
+
+# Function to compute the next-token negative log likelihood sum of every window from final hidden states
+def chunked_nll(hidden, lm_head, labels, vocab_chunk=16384, seq_chunk=512):
+    """
+    Cross-entropy against lm_head without materializing the (bs, seqlen, vocab) logits.
+
+    The logits are produced one (seq_chunk, vocab_chunk) block at a time; the logsumexp is carried
+    across vocabulary chunks and the target logit is picked from the chunk that holds it, so peak
+    memory is bs * seq_chunk * vocab_chunk floats whatever the vocabulary size.
+
+    Args:
+        hidden (torch.Tensor): Final (normed) hidden states of shape (bs, seqlen, hidden_size).
+        lm_head (nn.Linear): Output projection.
+        labels (torch.Tensor): Input ids of shape (bs, seqlen); position t predicts labels[:, t+1].
+        vocab_chunk (int): Vocabulary rows of lm_head per block.
+        seq_chunk (int): Positions per block.
 
-    # Print status
-    print(f"evaluating on {dataset}")
+    Returns:
+        torch.Tensor: float32 tensor of shape (bs,) with the summed NLL of each window.
+    """
+    weight, bias = lm_head.weight, lm_head.bias
+    hidden = hidden[:, :-1].to(weight.device)
+    labels = labels[:, 1:].to(weight.device)
+    nll = torch.zeros(hidden.shape[0], dtype=torch.float32, device=weight.device)
+    for s0 in range(0, hidden.shape[1], seq_chunk):
+        h = hidden[:, s0:s0+seq_chunk]
+        y = labels[:, s0:s0+seq_chunk]
+        lse = torch.full(y.shape, float("-inf"), dtype=torch.float32, device=weight.device)
+        target = torch.zeros(y.shape, dtype=torch.float32, device=weight.device)
+        for v0 in range(0, weight.shape[0], vocab_chunk):
+            v1 = min(v0 + vocab_chunk, weight.shape[0])
+            logits = F.linear(h, weight[v0:v1], None if bias is None else bias[v0:v1]).float()
+            lse = torch.logaddexp(lse, torch.logsumexp(logits, dim=-1))
+            in_chunk = (y >= v0) & (y < v1)
+            picked = logits.gather(-1, (y - v0).clamp(0, v1 - v0 - 1).unsqueeze(-1)).squeeze(-1)
+            target += torch.where(in_chunk, picked, torch.zeros_like(picked))
+        nll += (lse - target).sum(dim=1)
+    return nll
 
-    # Get the test loader
-    _, testloader = get_loaders(
-        dataset, seed=0, seqlen=model.seqlen, tokenizer=tokenizer 
-    )
+# Function to compute the mean next-token negative log likelihood of each window in a batch
+def window_nll(model, inputs, vocab_chunk=0):
+    if vocab_chunk > 0:
+        # Final hidden states only, the loss is computed against lm_head in chunks
+        hidden = model.get_decoder()(inputs, use_cache=False)[0]
+        return chunked_nll(hidden, model.get_output_embeddings(), inputs, vocab_chunk) / (inputs.shape[1] - 1)
 
-    # Evaluate ppl in no grad context to avoid updating the model
-    with torch.no_grad():
-        ppl = eval_ppl_wikitext(model, testloader, 1, device)
-    return ppl 
+    # Forward pass through the model
+    lm_logits = model(inputs).logits
 
-# Function to evaluate perplexity (ppl) specifically on the wikitext dataset
-def eval_ppl_wikitext(model, testenc, bs=1, device=None):
+    # Shift logits and labels for next token prediction
+    shift_logits = lm_logits[:, :-1, :].contiguous()
+    shift_labels = inputs[:, 1:]
+
+    # Compute loss
+    loss_fct = nn.CrossEntropyLoss(reduction='none')
+    loss = loss_fct(shift_logits.reshape(-1, shift_logits.size(-1)), shift_labels.reshape(-1))
+    return loss.float().reshape(inputs.shape[0], -1).mean(dim=1)
+
+# Function to evaluate perplexity (ppl) on a tokenized test set split into seqlen windows
+def eval_ppl_wikitext(model, testenc, bs=1, device=None, vocab_chunk=0):
     # Get input IDs
-    testenc = testenc.input_ids
+    testenc = getattr(testenc, 'input_ids', testenc)
 
     # Calculate number of samples
     nsamples = testenc.numel() // model.seqlen
 
-    # List to store negative log likelihoods
-    nlls = []
+    # Running sum of negative log likelihoods
+    nll_sum = torch.zeros((), dtype=torch.float64, device=device)
     print(f"nsamples {nsamples}")
+    start = time.time()
 
     # Loop through each batch
     for i in range(0,nsamples,bs):
@@ -48,27 +134,127 @@ def eval_ppl_wikitext(model, testenc, bs=1, device=None):
         inputs = testenc[:,(i * model.seqlen):(j * model.seqlen)].to(device)
         inputs = inputs.reshape(j-i, model.seqlen)
 
-        # Forward pass through the model
-        lm_logits = model(inputs).logits
+        # Accumulate negative log likelihood
+        nll_sum += window_nll(model, inputs, vocab_chunk).double().sum().to(nll_sum.device) * model.seqlen
 
-        # Shift logits and labels for next token prediction
-        shift_logits = lm_logits[:, :-1, :].contiguous()
-        shift_labels = inputs[:, 1:]
+    # Compute perplexity
+    ppl = torch.exp(nll_sum / (nsamples * model.seqlen))
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = time.time() - start
+    print(f"{nsamples * model.seqlen} tokens in {elapsed:.1f}s ({nsamples * model.seqlen / elapsed:.0f} tokens/s)")
 
-        # Compute loss
-        loss_fct = nn.CrossEntropyLoss()
-        loss = loss_fct(shift_logits.reshape(-1, shift_logits.size(-1)), shift_labels.reshape(-1))
+    # Empty CUDA cache to save memory
+    torch.cuda.empty_cache()
 
-        # Calculate negative log likelihood
-        neg_log_likelihood = loss.float() * model.seqlen * (j-i)
+    return ppl.item()
 
-        # Append to list of negative log likelihoods
-        nlls.append(neg_log_likelihood)
+# Context manager moving the CPU-resident modules among `modules` to device, and back on exit
+@contextmanager
+def on_device(modules, device):
+    moved = []
+    for m in modules:
+        tensors = list(m.parameters()) + list(m.buffers())
+        if tensors and tensors[0].device.type == "cpu" and torch.device(device).type != "cpu":
+            m.to(device)
+            moved.append(m)
+    try:
+        yield
+    finally:
+        for m in moved:
+            m.to("cpu")
 
-    # Compute perplexity
-    ppl = torch.exp(torch.stack(nlls).sum() / (nsamples * model.seqlen))
+# Function to evaluate perplexity (ppl) one decoder layer at a time, like the pruning loops
+def eval_ppl_layerwise(model, testenc, bs=1, device=None, vocab_chunk=0, store="memory", store_dir=None):
+    """
+    Same perplexity as eval_ppl_wikitext, computed by running every test window through one decoder
+    layer before moving on to the next. Modules held on the CPU (embedding, each decoder layer, the
+    final norm and lm_head) are moved to device for their pass and back afterwards, and layers
+    offloaded by accelerate are loaded by their hooks, so the GPU holds one layer plus the activation
+    buffers; store="mmap" keeps those buffers on disk as well.
+    """
+    testenc = getattr(testenc, 'input_ids', testenc)
+    nsamples = testenc.numel() // model.seqlen
+    print(f"nsamples {nsamples}")
+    start = time.time()
 
-    # Empty CUDA cache to save memory
+    use_cache = getattr(model.config, "use_cache", False)
+    setattr(model.config, "use_cache", False)
+    windows = [(testenc[:, (i * model.seqlen):((i + 1) * model.seqlen)],) for i in range(nsamples)]
+    decoder = model.get_decoder()
+    ## the embedding (and rotary embedding) run on device, so the ids prepare_calibration_input feeds on device match it
+    embedding_modules = [model.get_input_embeddings()] + ([decoder.rotary_emb] if hasattr(decoder, "rotary_emb") else [])
+    with on_device(embedding_modules, device):
+        inps, outs, attention_mask, position_embeddings = prepare_calibration_input(model, windows, nsamples, device, bs, store, store_dir)
+    if attention_mask is not None:
+        attention_mask = attention_mask.to(device)
+    if position_embeddings is not None:
+        position_embeddings = tuple(t.to(device) for t in position_embeddings)
+
+    layers = get_lm_layers(model)
+    for i in range(len(layers)):
+        with on_device([layers[i]], device):
+            layer_forward(layers[i], inps, outs, nsamples, bs, attention_mask=attention_mask, position_embeddings=position_embeddings)
+        inps, outs = outs, inps
+    setattr(model.config, "use_cache", use_cache)
+
+    # Final norm and lm_head over the last layer's outputs
+    norm = decoder.norm
+    lm_head = model.get_output_embeddings()
+    nll_sum = torch.zeros((), dtype=torch.float64, device=device)
+    with on_device([norm, lm_head], device):
+        for j in range(0, nsamples, bs):
+            hidden = norm(inps[j:j+bs].to(device))
+            labels = torch.cat([w[0] for w in windows[j:j+bs]]).to(device)
+            nll = chunked_nll(hidden, lm_head, labels, vocab_chunk if vocab_chunk > 0 else lm_head.weight.shape[0])
+            ## same normalization as eval_ppl_wikitext
+            nll_sum += nll.double().sum().to(device) / (model.seqlen - 1) * model.seqlen
+
+    ppl = torch.exp(nll_sum / (nsamples * model.seqlen))
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = time.time() - start
+    print(f"{nsamples * model.seqlen} tokens in {elapsed:.1f}s ({nsamples * model.seqlen / elapsed:.0f} tokens/s)")
+    torch.cuda.empty_cache()
+
+    return ppl.item()
+
+# Function to estimate perplexity from a seeded random subset of the windows, stopping early
+def eval_ppl_estimate(model, testenc, bs=1, device=None, vocab_chunk=0, tolerance=0.01, seed=0, min_windows=16, z=1.96):
+    """
+    Windows are evaluated in a seeded random order while the mean and variance of their NLL are
+    tracked (Welford). Evaluation stops once the z-interval exp(mean +- z * stderr) on perplexity is
+    narrower than tolerance * ppl; stderr carries the finite population correction, so the estimate
+    becomes the exact eval_ppl_wikitext value when every window ends up being used.
+
+    Returns:
+        tuple: Estimated perplexity, the interval bounds, and the number of test tokens used.
+    """
+    testenc = getattr(testenc, 'input_ids', testenc)
+    nsamples = testenc.numel() // model.seqlen
+    windows = testenc[:, :(nsamples * model.seqlen)].reshape(nsamples, model.seqlen)
+    order = torch.randperm(nsamples, generator=torch.Generator().manual_seed(seed))
+    start = time.time()
+
+    n, mean, m2 = 0, 0.0, 0.0
+    half_width = float("inf")
+    for i in range(0, nsamples, bs):
+        inputs = windows[order[i:i+bs]].to(device)
+        for x in window_nll(model, inputs, vocab_chunk).tolist():
+            n += 1
+            delta = x - mean
+            mean += delta / n
+            m2 += delta * (x - mean)
+        if n < min(min_windows, nsamples):
+            continue
+        var = m2 / (n - 1) if n > 1 else 0.0
+        half_width = z * math.sqrt(var / n * (nsamples - n) / max(nsamples - 1, 1))
+        if math.exp(mean + half_width) - math.exp(mean - half_width) <= tolerance * math.exp(mean):
+            break
+
+    ppl, ci_low, ci_high = math.exp(mean), math.exp(mean - half_width), math.exp(mean + half_width)
+    elapsed = time.time() - start
+    print(f"ppl {ppl:.4f} ({ci_low:.4f}, {ci_high:.4f}) from {n}/{nsamples} windows, {n * model.seqlen} tokens in {elapsed:.1f}s")
     torch.cuda.empty_cache()
 
-    return ppl.item()
\ No newline at end of file
+    return ppl, ci_low, ci_high, n * model.seqlen
@@ -0,0 +1,117 @@
+#gradients.py
+import json
+import os
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+INDEX_NAME = "index.json"
+LOG8_LEVELS = 254  ## code 0 is reserved for exact zeros
+
+
+def encode_log8(tensor):
+    """
+    Encode a non-negative gradient magnitude as 8-bit codes on a per-row log2 scale.
+
+    Args:
+        tensor (torch.Tensor): Non-negative tensor of shape (rows, columns).
+
+    Returns:
+        tuple: uint8 codes of the same shape, and the float32 per-row log2 minimum and step.
+    """
+    x = tensor.float()
+    positive = x > 0
+    log_x = torch.log2(torch.where(positive, x, torch.ones_like(x)))
+    log_min = torch.where(positive, log_x, torch.full_like(log_x, float("inf"))).amin(dim=1)
+    log_max = torch.where(positive, log_x, torch.full_like(log_x, float("-inf"))).amax(dim=1)
+    empty = ~positive.any(dim=1)
+    log_min[empty] = 0
+    log_max[empty] = 0
+    log_step = torch.where(log_max > log_min, (log_max - log_min) / (LOG8_LEVELS - 1), torch.ones_like(log_min))
+    codes = ((log_x - log_min.reshape((-1,1))) / log_step.reshape((-1,1))).round_().clamp_(0, LOG8_LEVELS - 1) + 1
+    codes[~positive] = 0
+    return codes.to(torch.uint8), log_min, log_step
+
+
+def decode_log8(codes, log_min, log_step, dtype=torch.float16):
+    """
+    Inverse of encode_log8.
+    """
+    x = torch.exp2(log_min.reshape((-1,1)) + (codes.float() - 1) * log_step.reshape((-1,1)))
+    x[codes == 0] = 0
+    return x.to(dtype)
+
+
+def save_gradients(gradients, path, encoding="fp16"):
+    """
+    Write a gradient dict as one safetensors shard per decoder layer plus an index.
+
+    Args:
+        gradients (dict): Tensors keyed by "{name}_layer_{i}".
+        path (str): Output directory.
+        encoding (str): "fp16" stores the tensors as given, "log8" stores the magnitudes
+            with encode_log8 (codes, log_min and log_step entries per tensor).
+    """
+    os.makedirs(path, exist_ok=True)
+    shards = {}
+    weight_map = {}
+    for indexed_name, tensor in gradients.items():
+        layer_id = int(indexed_name.rsplit("_layer_", 1)[1])
+        shard = shards.setdefault(layer_id, {})
+        weight_map[indexed_name] = f"layer_{layer_id}.safetensors"
+        if encoding == "log8":
+            codes, log_min, log_step = encode_log8(torch.abs(tensor))
+            shard[f"{indexed_name}.codes"] = codes
+            shard[f"{indexed_name}.log_min"] = log_min
+            shard[f"{indexed_name}.log_step"] = log_step
+        else:
+            shard[indexed_name] = tensor.contiguous()
+    for layer_id, tensors in sorted(shards.items()):
+        save_file(tensors, os.path.join(path, f"layer_{layer_id}.safetensors"))
+    with open(os.path.join(path, INDEX_NAME), "w") as f:
+        json.dump({"encoding": encoding, "weight_map": weight_map}, f, indent=2)
+
+
+class GradientStore:
+    """
+    Per-layer access to the gradients written by gradient_computation.py.
+
+    The path is either a sharded directory (index.json plus memory-mapped safetensors shards)
+    or a monolithic .pth file, which is memory-mapped by torch.load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.isdir(path):
+            with open(os.path.join(path, INDEX_NAME)) as f:
+                index = json.load(f)
+            self.weight_map = index["weight_map"]
+            self.encoding = index.get("encoding", "fp16")
+            self.gradients = None
+        else:
+            if not os.path.exists(path) and os.path.isdir(path[:-len(".pth")] if path.endswith(".pth") else ""):
+                raise FileNotFoundError(f"{path} does not exist; gradients saved with --save_format sharded are a directory, pass {path[:-len('.pth')]}")
+            self.weight_map = None
+            self.encoding = "fp16"
+            self.gradients = torch.load(path, map_location=torch.device('cpu'), mmap=True)
+
+    def load_layer(self, layer_id):
+        """
+        Returns:
+            dict: The "{name}_layer_{layer_id}" tensors of one decoder layer, decoded to fp16
+            magnitudes for the log8 encoding.
+        """
+        suffix = f"_layer_{layer_id}"
+        if self.weight_map is None:
+            return {name: g for name, g in self.gradients.items() if name.endswith(suffix)}
+        layer_gradients = {}
+        filenames = {filename for name, filename in self.weight_map.items() if name.endswith(suffix)}
+        for filename in filenames:
+            with safe_open(os.path.join(self.path, filename), framework="pt", device="cpu") as f:
+                if self.encoding == "log8":
+                    for name in {key.rsplit(".", 1)[0] for key in f.keys()}:
+                        layer_gradients[name] = decode_log8(f.get_tensor(f"{name}.codes"), f.get_tensor(f"{name}.log_min"), f.get_tensor(f"{name}.log_step"))
+                else:
+                    for name in f.keys():
+                        layer_gradients[name] = f.get_tensor(name)
+        return layer_gradients
@@ -0,0 +1,122 @@
+#mask.py
+import torch
+
+
+def nm_mask(W_metric, prune_n, prune_m):
+    """
+    Select the prune_n smallest entries of every group of prune_m consecutive input columns.
+
+    Args:
+        W_metric (torch.Tensor): Pruning metric of shape (rows, columns).
+        prune_n (int): Number of weights to prune in each group.
+        prune_m (int): Group size.
+
+    Returns:
+        torch.Tensor: Boolean mask of the same shape as W_metric, True for weights to prune.
+    """
+    rows, columns = W_metric.shape
+    full = columns - columns % prune_m
+    ## all complete groups in one batched topk over a (rows, groups, m) view
+    tmp = W_metric[:, :full].float().reshape(rows, full // prune_m, prune_m)
+    group_mask = torch.zeros(tmp.shape, dtype=torch.bool, device=W_metric.device)
+    group_mask.scatter_(-1, torch.topk(tmp, prune_n, dim=-1, largest=False)[1], True)
+    if full == columns:
+        return group_mask.reshape(rows, columns)
+    W_mask = torch.zeros((rows, columns), dtype=torch.bool, device=W_metric.device)
+    W_mask[:, :full] = group_mask.reshape(rows, full)
+    ## trailing partial group, handled the same way as the column loop did
+    tmp = W_metric[:, full:].float()
+    W_mask.scatter_(1, full + torch.topk(tmp, min(prune_n, tmp.shape[1]), dim=1, largest=False)[1], True)
+    return W_mask
+
+
+def row_mask(W_metric, num_prune):
+    """
+    Select the num_prune smallest entries of every row without a full sort.
+
+    Ties at the threshold are broken towards lower column indices, so the mask is the
+    same as taking the first num_prune indices of torch.sort(W_metric, dim=-1, stable=True).
+
+    Args:
+        W_metric (torch.Tensor): Pruning metric of shape (rows, columns).
+        num_prune (int): Number of weights to prune in each row.
+
+    Returns:
+        torch.Tensor: Boolean mask of the same shape as W_metric, True for weights to prune.
+    """
+    if num_prune == 0:
+        return torch.zeros(W_metric.shape, dtype=torch.bool, device=W_metric.device)
+    thres = torch.kthvalue(W_metric, num_prune, dim=1, keepdim=True)[0]
+    W_mask = W_metric < thres
+    ties = W_metric == thres
+    remaining = num_prune - W_mask.sum(dim=1, keepdim=True)
+    if (ties.sum(dim=1, keepdim=True) > remaining).any():
+        ties &= ties.cumsum(dim=1) <= remaining
+    return W_mask | ties
+
+
+def prune_rows_tiled(W, metric_fn, sparsity_ratio, tile_rows):
+    """
+    Unstructured per-row pruning of W, computing the metric and mask one row tile at a time.
+
+    Args:
+        W (torch.Tensor): Weight of shape (rows, columns), zeroed in place.
+        metric_fn (callable): metric_fn(r0, r1) returns the metric for rows r0:r1.
+        sparsity_ratio (float): Fraction of each row to prune.
+        tile_rows (int): Number of rows per tile, bounds the extra memory.
+    """
+    rows, columns = W.shape
+    num_prune = int(columns * sparsity_ratio)
+    for r0 in range(0, rows, tile_rows):
+        r1 = min(r0 + tile_rows, rows)
+        W_mask = row_mask(metric_fn(r0, r1), num_prune)
+        W[r0:r1][W_mask] = 0
+
+
+def kth_smallest(chunks, k, bins=2048, max_candidates=1 << 22):
+    """
+    Exact k-th smallest value (0-based) of a stream of tensors, found by histogram refinement.
+
+    Each round histograms the values that fall inside the current [lo, hi] range, keeps only the
+    bin holding the k-th value and narrows the range to that bin's min and max. Once the bin is
+    small enough its values are gathered and resolved with kthvalue, so neither a full sort nor a
+    flattened copy of the data is ever materialized.
+
+    Args:
+        chunks (callable): Returns a fresh iterable over the tensors; called once per round.
+        k (int): 0-based rank of the value to find.
+        bins (int): Number of histogram bins per round.
+        max_candidates (int): Bin size below which the candidates are gathered directly.
+
+    Returns:
+        float: The k-th smallest value, equal to torch.sort(all values)[0][k].
+    """
+    lo, hi = float("inf"), float("-inf")
+    for c in chunks():
+        lo = min(lo, c.min().item())
+        hi = max(hi, c.max().item())
+    below = 0  ## number of values strictly below lo
+    while lo < hi:
+        counts = torch.zeros(bins, dtype=torch.int64)
+        bin_min = torch.full((bins,), float("inf"))
+        bin_max = torch.full((bins,), float("-inf"))
+        for c in chunks():
+            c = c.flatten().float()
+            c = c[(c >= lo) & (c <= hi)]
+            ## monotone in c, so every bin covers a contiguous range of values
+            idx = ((c - lo) * (bins / (hi - lo))).long().clamp_(0, bins - 1)
+            counts += torch.bincount(idx, minlength=bins).cpu()
+            bin_min = torch.minimum(bin_min, torch.full((bins,), float("inf"), device=c.device).scatter_reduce_(0, idx, c, "amin").cpu())
+            bin_max = torch.maximum(bin_max, torch.full((bins,), float("-inf"), device=c.device).scatter_reduce_(0, idx, c, "amax").cpu())
+        cum = torch.cumsum(counts, dim=0)
+        b = int(torch.searchsorted(cum, torch.tensor([k - below]), right=True)[0])
+        if b > 0:
+            below += int(cum[b - 1])
+        lo, hi = bin_min[b].item(), bin_max[b].item()
+        if counts[b] <= max_candidates:
+            candidates = []
+            for c in chunks():
+                c = c.flatten().float()
+                candidates.append(c[(c >= lo) & (c <= hi)].cpu())
+            return torch.kthvalue(torch.cat(candidates), k - below + 1)[0].item()
+    return lo
@@ -5,6 +5,10 @@ import torch
 import torch.nn as nn 
 from .sparsegpt import SparseGPT 
 from .layerwrapper import WrappedGPT
+from .mask import nm_mask, prune_rows_tiled, kth_smallest
+from .activations import alloc_activations
+from .gradients import GradientStore
+from .quant import quantize_linear
 from .data import get_loaders 
 from torch.utils.data import DataLoader
 import torch.nn.functional as F
@@ -127,7 +131,7 @@ def check_sparsity(model, args):
     setattr(model.config, "use_cache", use_cache)
     return float(count)/total_params 
 
-def prepare_calibration_input(model, dataloader, nsamples, device):
+def prepare_calibration_input(model, dataloader, nsamples, device, batch_size=1, store="memory", store_dir=None, fmt="native"):
     use_cache = getattr(model.config, "use_cache", False)
     setattr(model.config, "use_cache", False)
     layers = get_lm_layers(model)
@@ -147,7 +151,7 @@ def prepare_calibration_input(model, dataloader, nsamples, device):
 
     dtype = next(iter(model.parameters())).dtype
     hidden_size = get_hidden_size(model)
-    inps = torch.zeros((nsamples, model.seqlen, hidden_size), dtype=dtype, device=device)
+    inps = alloc_activations((nsamples, model.seqlen, hidden_size), dtype, device, store, store_dir, fmt)
     inps.requires_grad = False
     cache = {'i': 0, 'attention_mask': None, "position_embeddings": None}
 
@@ -166,27 +170,96 @@ def prepare_calibration_input(model, dataloader, nsamples, device):
             # print(">>>> kwargs >>>>>>>>>")
             # print(kwargs)
             # print(">>>> kwargs >>>>>>>>>")
-            inps[cache['i']] = inp
-            cache['i'] += 1
-            cache['attention_mask'] = kwargs['attention_mask']
-            cache['position_embeddings'] = kwargs['position_embeddings']
+            if cache['i'] == 0:
+                cache['attention_mask'] = kwargs['attention_mask']
+                cache['position_embeddings'] = kwargs['position_embeddings']
+            inps[cache['i']:cache['i'] + inp.shape[0]] = inp
+            cache['i'] += inp.shape[0]
             raise ValueError
     # Replace the first layer with Catcher to capture input
     layers[0] = Catcher(layers[0])
-    for batch in dataloader:
+    # The first sample goes in alone so that the cached attention mask and position
+    # embeddings have batch size 1 and broadcast over micro-batches of any size.
+    j = 0
+    while j < len(dataloader):
+        size = 1 if j == 0 else batch_size
         try:
-            model(batch[0].to(device))
+            model(torch.cat([batch[0] for batch in dataloader[j:j+size]]).to(device))
         except ValueError:
             pass 
+        j += size
     layers[0] = layers[0].module
 
-    outs = torch.zeros_like(inps)
+    outs = alloc_activations(inps.shape, dtype, device, store, store_dir, fmt)
     attention_mask = cache['attention_mask']
     position_embeddings = cache['position_embeddings']
     setattr(model.config, "use_cache", use_cache)
 
     return inps, outs, attention_mask, position_embeddings 
 
+def layer_forward(layer, inps, outs, nsamples, batch_size=1, **kwargs):
+    """
+    Run the calibration samples through a decoder layer in micro-batches of batch_size,
+    writing the hidden states into outs. Only the current micro-batch is moved to the
+    layer's device, so inps and outs may live on another device or on disk.
+    """
+    dev = next(layer.parameters()).device
+    for j in range(0, nsamples, batch_size):
+        inp = inps[j:j+batch_size]
+        if dev.type != "meta":  ## offloaded layers move their inputs themselves
+            inp = inp.to(dev)
+        out = layer(inp, **kwargs)
+        if isinstance(out, tuple):
+            out = out[0]
+        outs[j:j+batch_size] = out
+
+def local_gradients(layer, subset, layer_id, inps, dense_inps, nsamples, batch_size=1, grad_norm="l1", scale=100, **kwargs):
+    """
+    Gradient magnitudes of a decoder layer's Linear weights under a local reconstruction loss,
+    the squared error between the layer's output on the pruned-model inputs (inps) and on the
+    dense-model inputs (dense_inps). Per-sample gradients are accumulated as in
+    gradient_computation.py, as an l1 sum or the square root of an l2 sum. dense_inps is
+    overwritten in place with this layer's dense outputs, the next layer's dense inputs.
+
+    Returns:
+        dict: fp16 gradient magnitudes keyed by "{name}_layer_{layer_id}".
+    """
+    dev = next(layer.parameters()).device
+    weights = {f"{name}_layer_{layer_id}": subset[name].weight for name in subset}
+    accumulators = {indexed_name: torch.zeros_like(W, dtype=torch.float32) for indexed_name, W in weights.items()}
+    requires_grad = [(p, p.requires_grad) for p in layer.parameters()]
+    for p, _ in requires_grad:
+        p.requires_grad_(False)
+    for W in weights.values():
+        W.requires_grad_(True)
+
+    for j in range(0, nsamples, batch_size):
+        inp, dense_inp = inps[j:j+batch_size], dense_inps[j:j+batch_size]
+        if dev.type != "meta":
+            inp, dense_inp = inp.to(dev), dense_inp.to(dev)
+        with torch.no_grad():
+            target = layer(dense_inp, **kwargs)
+            if isinstance(target, tuple):
+                target = target[0]
+        with torch.enable_grad():
+            out = layer(inp, **kwargs)
+            if isinstance(out, tuple):
+                out = out[0]
+            for b in range(out.shape[0]):
+                ## squared error summed over the hidden size, averaged over the tokens
+                loss = 0.5 * (out[b] - target[b]).to(dtype=torch.float32).pow(2).sum(dim=-1).mean()
+                grads = torch.autograd.grad(loss, list(weights.values()), retain_graph=b < out.shape[0] - 1)
+                for indexed_name, grad in zip(weights, grads):
+                    grad = grad.to(dtype=torch.float32) * scale
+                    accumulators[indexed_name] += torch.abs(grad) if grad_norm == "l1" else grad ** 2
+        dense_inps[j:j+batch_size] = target
+
+    for p, flag in requires_grad:
+        p.requires_grad_(flag)
+    if grad_norm == "l2":
+        accumulators = {indexed_name: torch.sqrt(acc) for indexed_name, acc in accumulators.items()}
+    return {indexed_name: acc.to(dtype=torch.float16) for indexed_name, acc in accumulators.items()}
+
 def return_given_alpha(alpha, sort_res, W_metric, tmp_metric, sum_before):
     thres_cumsum = sum_before * alpha 
     sort_mask = tmp_metric <= thres_cumsum.reshape((-1,1))
@@ -195,8 +268,39 @@ def return_given_alpha(alpha, sort_res, W_metric, tmp_metric, sum_before):
     cur_sparsity = (W_mask==True).sum() / W_mask.numel()
     return W_mask, cur_sparsity
 
+def wanda_metric(W, scaler_row):
+    return torch.abs(W) * torch.sqrt(scaler_row.reshape((1,-1)))
+
+def gblm_metric(W, scaler_row, gradient, gradient_inv=False):
+    W_metric = wanda_metric(W, scaler_row)
+    if not gradient_inv:
+        # small_value = torch.tensor(1e-8, dtype=gradient.dtype, device=gradient.device)
+        W_metric_grad = torch.abs(W) * torch.abs(gradient.to(device=W_metric.device))
+        W_metric = W_metric.to(dtype=torch.float32) + W_metric_grad.to(dtype=torch.float32)  #+ small_value)
+    else:
+        small_value = torch.tensor(1e-8, dtype=gradient.dtype, device=gradient.device)
+        gradient_inv = 1 / (torch.abs(gradient) + small_value)
+        W_metric = W_metric.to(dtype=torch.float32)  * gradient_inv.to(device=W_metric.device).to(dtype=torch.float32)
+    return W_metric
+
+def magnitude_threshold(weights, sparsity_ratio, chunk_rows=1024):
+    """
+    Magnitude below which sparsity_ratio of the given weights fall, streamed over row chunks.
+    Same value as torch.sort(torch.abs(W).flatten())[0][k] over the concatenated weights.
+    """
+    numel = sum(W.numel() for W in weights)
+    chunks = lambda: (torch.abs(c) for W in weights for c in W.split(chunk_rows))
+    return kth_smallest(chunks, int(numel*sparsity_ratio))
+
 def prune_magnitude(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0, prune_m=0, layer_no=-1):
     layers = get_lm_layers(model)
+    chunk_rows = args.tile_rows if args.tile_rows > 0 else 1024
+
+    if prune_n == 0 and args.magnitude_scope == "global":
+        ## one threshold for all decoder layers, streamed without holding their metrics together
+        weights = [W.weight.data for layer in layers for W in find_layers(layer).values()]
+        thresh = magnitude_threshold(weights, args.sparsity_ratio, chunk_rows)
+        print(f"global magnitude threshold {thresh}")
 
     for i in range(len(layers)):
         layer = layers[i]
@@ -204,65 +308,67 @@ def prune_magnitude(args, model, tokenizer, device=torch.device("cuda:0"), prune
 
         for name in subset:
             W = subset[name].weight.data 
-            W_metric = torch.abs(W)
             if prune_n != 0:
-                W_mask = (torch.zeros_like(W)==1)
-                for ii in range(W_metric.shape[1]):
-                    if ii % prune_m == 0:
-                        tmp = W_metric[:,ii:(ii+prune_m)].float()
-                        W_mask.scatter_(1,ii+torch.topk(tmp, prune_n,dim=1, largest=False)[1], True)
+                W_metric = torch.abs(W)
+                W_mask = nm_mask(W_metric, prune_n, prune_m)
+                W[W_mask] = 0
             else:
-                # thresh = torch.sort(W_metric.flatten().cuda())[0][int(W.numel()*args.sparsity_ratio)].cpu()
-                thresh = torch.sort(W_metric.flatten())[0][int(W_metric.numel()*args.sparsity_ratio)].cpu()
-                W_mask = (W_metric<=thresh)
-            
-            W[W_mask] = 0
+                if args.magnitude_scope == "layer":
+                    thresh = magnitude_threshold([W], args.sparsity_ratio, chunk_rows)
+                for W_chunk in W.split(chunk_rows):
+                    W_chunk[torch.abs(W_chunk)<=thresh] = 0
 
 def prune_gradient(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0, prune_m=0, layer_no=-1):
 
     layers = get_lm_layers(model)
-    with open(args.gradient_path, 'rb') as file:
-        gradients = torch.load(args.gradient_path, map_location=torch.device('cpu')) 
+    gradients = GradientStore(args.gradient_path)
     
     for i in range(len(layers)):
         layer = layers[i]
         subset = find_layers(layer)
+        layer_gradients = gradients.load_layer(i)  ## only this layer's gradients are resident
 
         for name in subset:
             indexed_name = f"{name}_layer_{i}"
             W = subset[name].weight.data 
             W_metric = torch.abs(W)
             if not args.gradient_inv:
-                W_metric = W_metric.to(dtype=torch.float32) * torch.abs(gradients[indexed_name].to(device=W_metric.device)).to(dtype=torch.float32)#+ small_value)
+                W_metric = W_metric.to(dtype=torch.float32) * torch.abs(layer_gradients[indexed_name].to(device=W_metric.device)).to(dtype=torch.float32)#+ small_value)
             else:
-                small_value = torch.tensor(1e-8, dtype=gradients[indexed_name].dtype, device=gradients[indexed_name].device)
-                gradient_inv = 1 / (torch.abs(gradients[indexed_name]) + small_value)
+                small_value = torch.tensor(1e-8, dtype=layer_gradients[indexed_name].dtype, device=layer_gradients[indexed_name].device)
+                gradient_inv = 1 / (torch.abs(layer_gradients[indexed_name]) + small_value)
                 W_metric = W_metric.to(dtype=torch.float32) * gradient_inv.to(device=W_metric.device).to(dtype=torch.float32)
-            W_mask = (torch.zeros_like(W)==1)
             if prune_n != 0:
-                for ii in range(W_metric.shape[1]):
-                    if ii % prune_m == 0:
-                        tmp = W_metric[:,ii:(ii+prune_m)].float()
-                        W_mask.scatter_(1,ii+torch.topk(tmp, prune_n,dim=1, largest=False)[1], True)
+                W_mask = nm_mask(W_metric, prune_n, prune_m)
             else:
+                W_mask = (torch.zeros_like(W)==1)
                 sort_res = torch.sort(W_metric, dim=-1, stable=True)
                 indices = sort_res[1][:,:int(W_metric.shape[1]*args.sparsity_ratio)]
                 W_mask.scatter_(1, indices, True)
 
             W[W_mask] = 0
+        del layer_gradients
 
 
 def prune_gblm(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0, prune_m=0, layer_no=-1):
     use_cache = getattr(model.config, "use_cache", False)
     setattr(model.config, "use_cache", False)
-    with open(args.gradient_path, 'rb') as file:
-        gradients = torch.load(args.gradient_path, map_location=torch.device('cpu')) 
+    print(f"gblm gradient source {args.gblm_gradient}")
+    if args.gblm_gradient == "file":
+        gradients = GradientStore(args.gradient_path)
+    else:
+        assert args.propagation == "pruned", "local gradients compare the pruned calibration stream with the dense one"
 
     print("loading calibration data")
-    dataloader, _ = get_loaders("c4",nsamples=args.nsamples,seed=args.seed,seqlen=2048,tokenizer=tokenizer)
+    dataloader, _ = get_loaders("c4",nsamples=args.nsamples,seed=args.seed,seqlen=2048,tokenizer=tokenizer,cache_dir=args.data_cache_dir,tokenize_workers=args.tokenize_workers)
     print("dataset loading complete")
     with torch.no_grad():
-        inps, outs, attention_mask, position_embeddings = prepare_calibration_input(model, dataloader, args.nsamples, device)
+        inps, outs, attention_mask, position_embeddings = prepare_calibration_input(model, dataloader, args.nsamples, device, args.calib_batch_size, args.activation_store, args.activation_dir, args.activation_dtype)
+        if args.gblm_gradient == "local":
+            ## calibration stream of the dense model, the target of the local reconstruction loss
+            dense_inps = alloc_activations(inps.shape, inps.dtype, inps.device, args.activation_store, args.activation_dir, args.activation_dtype)
+            for j in range(0, args.nsamples, args.calib_batch_size):
+                dense_inps[j:j+args.calib_batch_size] = inps[j:j+args.calib_batch_size]
 
     layers = get_lm_layers(model)
     for i in range(len(layers)):
@@ -286,8 +392,11 @@ def prune_gblm(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0,
         if layer_device_key:
             dev = model.hf_device_map[layer_device_key]
             # Device transfer
-            inps = inps.to(dev)
-            outs = outs.to(dev)
+            if args.activation_store == "memory":
+                inps = inps.to(dev)
+                outs = outs.to(dev)
+                if args.gblm_gradient == "local":
+                    dense_inps = dense_inps.to(dev)
             if attention_mask is not None:
                 print("attention mask is not none, shape is: ", attention_mask.shape)
                 attention_mask = attention_mask.to(dev)
@@ -295,6 +404,16 @@ def prune_gblm(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0,
             if position_embeddings is not None:
                 # position_embeddings = position_embeddings.to(dev)
                 position_embeddings = tuple(t.to(dev) for t in position_embeddings)
+        if args.gblm_gradient == "local":
+            ## gradients of this layer alone, computed before any of its weights are pruned
+            layer_gradients = local_gradients(layer, subset, i, inps, dense_inps, args.nsamples, args.calib_batch_size, args.local_grad_norm, args.local_grad_scale, attention_mask=attention_mask, position_embeddings=position_embeddings)
+            if not any(g.any() for g in layer_gradients.values()):
+                ## the pruned and dense streams still agree (always the case for the first layer), the
+                ## local loss is at its minimum and carries no signal: prune with the wanda term alone
+                print(f"layer {i}: local gradients are zero, pruning with the wanda metric")
+                layer_gradients = None
+        else:
+            layer_gradients = gradients.load_layer(i)  ## only this layer's gradients are resident
         wrapped_layers = {}
         for name in subset:
             wrapped_layers[name] = WrappedGPT(subset[name], layer_id=i, layer_name=name)
@@ -307,9 +426,8 @@ def prune_gblm(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0,
         handles = []
         for name in wrapped_layers:
             handles.append(subset[name].register_forward_hook(add_batch(name))) ## this is a important function.
-        for j in range(args.nsamples):
-            with torch.no_grad():
-                outs[j] = layer(inps[j].unsqueeze(0), attention_mask=attention_mask, position_embeddings=position_embeddings)[0]
+        with torch.no_grad():
+            layer_forward(layer, inps, outs, args.nsamples, args.calib_batch_size, attention_mask=attention_mask, position_embeddings=position_embeddings)
 
         for h in handles:
             h.remove() 
@@ -317,23 +435,23 @@ def prune_gblm(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0,
         for sub_i, name in enumerate(subset):
             indexed_name = f"{name}_layer_{i}"
             print(f"pruning layer {i} name {name}")
-            W_metric = torch.abs(subset[name].weight.data) * torch.sqrt(wrapped_layers[name].scaler_row.reshape((1,-1)))
-            if not args.gradient_inv:
-                # small_value = torch.tensor(1e-8, dtype=gradients[indexed_name].dtype, device=gradients[indexed_name].device)
-                W_metric_grad = torch.abs(subset[name].weight.data)* torch.abs(gradients[indexed_name].to(device=W_metric.device))
-                W_metric = W_metric.to(dtype=torch.float32) + W_metric_grad.to(dtype=torch.float32)  #+ small_value)
+            W = subset[name].weight.data
+            scaler_row = wrapped_layers[name].scaler_row
+            if layer_gradients is None:
+                metric_fn = lambda r0, r1: wanda_metric(W[r0:r1], scaler_row)
             else:
-                small_value = torch.tensor(1e-8, dtype=gradients[indexed_name].dtype, device=gradients[indexed_name].device)
-                gradient_inv = 1 / (torch.abs(gradients[indexed_name]) + small_value)
-                W_metric = W_metric.to(dtype=torch.float32)  * gradient_inv.to(device=W_metric.device).to(dtype=torch.float32) 
+                gradient = layer_gradients[indexed_name]
+                metric_fn = lambda r0, r1: gblm_metric(W[r0:r1], scaler_row, gradient[r0:r1], args.gradient_inv)
+            if prune_n == 0 and not args.use_variant and args.tile_rows > 0:
+                ## row-tiled unstructured pruning, same mask as the full sort below
+                prune_rows_tiled(W, metric_fn, args.sparsity_ratio, args.tile_rows)
+                continue
+            W_metric = metric_fn(0, W.shape[0])
 
             W_mask = (torch.zeros_like(W_metric) == 1)  ## initialize a mask to be all False
             if prune_n != 0:
                 # structured n:m sparsity
-                for ii in range(W_metric.shape[1]):
-                    if ii % prune_m == 0:
-                        tmp = W_metric[:,ii:(ii+prune_m)].float()
-                        W_mask.scatter_(1,ii+torch.topk(tmp, prune_n,dim=1, largest=False)[1], True)
+                W_mask = nm_mask(W_metric, prune_n, prune_m)
             else:
                 sort_res = torch.sort(W_metric, dim=-1, stable=True)
 
@@ -363,10 +481,16 @@ def prune_gblm(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0,
 
             subset[name].weight.data[W_mask] = 0  ## set weights to zero 
 
-        for j in range(args.nsamples):
+        if args.quantize == "int8":
+            for name in subset:
+                quantize_linear(subset[name], wrapped_layers[name].scaler_row, args.quant_grid)
+
+        ## "dense" propagation keeps the outputs of the statistics pass as the next layer's inputs
+        if args.propagation == "pruned":
             with torch.no_grad():
-                outs[j] = layer(inps[j].unsqueeze(0), attention_mask=None, position_embeddings=position_embeddings)[0]
+                layer_forward(layer, inps, outs, args.nsamples, args.calib_batch_size, attention_mask=None, position_embeddings=position_embeddings)
         inps, outs = outs, inps
+        del layer_gradients
 
     setattr(model.config, "use_cache", use_cache)
     torch.cuda.empty_cache()
@@ -377,10 +501,10 @@ def prune_wanda(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0
     setattr(model.config, "use_cache", False)
 
     print("loading calibration data")
-    dataloader, _ = get_loaders("c4",nsamples=args.nsamples,seed=args.seed,seqlen=model.seqlen,tokenizer=tokenizer)
+    dataloader, _ = get_loaders("c4",nsamples=args.nsamples,seed=args.seed,seqlen=model.seqlen,tokenizer=tokenizer,cache_dir=args.data_cache_dir,tokenize_workers=args.tokenize_workers)
     print("dataset loading complete")
     with torch.no_grad():
-        inps, outs, attention_mask, position_embeddings = prepare_calibration_input(model, dataloader, args.nsamples, device)
+        inps, outs, attention_mask, position_embeddings = prepare_calibration_input(model, dataloader, args.nsamples, device, args.calib_batch_size, args.activation_store, args.activation_dir, args.activation_dtype)
 
     layers = get_lm_layers(model)
 
@@ -391,8 +515,9 @@ def prune_wanda(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0
         if f"model.layers.{i}" in model.hf_device_map:   ## handle the case for llama-30B and llama-65B, when the device map has multiple GPUs;
             dev = model.hf_device_map[f"model.layers.{i}"]
             # inps, outs, attention_mask, position_embeddings = inps.to(dev), outs.to(dev), attention_mask.to(dev), position_embeddings.to(dev)
-            inps = inps.to(dev)
-            outs = outs.to(dev)
+            if args.activation_store == "memory":
+                inps = inps.to(dev)
+                outs = outs.to(dev)
             if attention_mask is not None:
                 print("attention mask is not none, shape is: ", attention_mask.shape)
                 attention_mask = attention_mask.to(dev)
@@ -414,24 +539,26 @@ def prune_wanda(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0
         handles = []
         for name in wrapped_layers:
             handles.append(subset[name].register_forward_hook(add_batch(name))) ## this is a important function.
-        for j in range(args.nsamples):
-            with torch.no_grad():
-                outs[j] = layer(inps[j].unsqueeze(0), attention_mask=attention_mask, position_embeddings=position_embeddings)[0]
+        with torch.no_grad():
+            layer_forward(layer, inps, outs, args.nsamples, args.calib_batch_size, attention_mask=attention_mask, position_embeddings=position_embeddings)
 
         for h in handles:
             h.remove() 
 
         for name in subset:
             print(f"pruning layer {i} name {name}")
-            W_metric = torch.abs(subset[name].weight.data) * torch.sqrt(wrapped_layers[name].scaler_row.reshape((1,-1)))
+            W = subset[name].weight.data
+            scaler_row = wrapped_layers[name].scaler_row
+            if prune_n == 0 and not args.use_variant and args.tile_rows > 0:
+                ## row-tiled unstructured pruning, same mask as the full sort below
+                prune_rows_tiled(W, lambda r0, r1: wanda_metric(W[r0:r1], scaler_row), args.sparsity_ratio, args.tile_rows)
+                continue
+            W_metric = wanda_metric(W, scaler_row)
 
             W_mask = (torch.zeros_like(W_metric) == 1)  ## initialize a mask to be all False
             if prune_n != 0:
                 # structured n:m sparsity
-                for ii in range(W_metric.shape[1]):
-                    if ii % prune_m == 0:
-                        tmp = W_metric[:,ii:(ii+prune_m)].float()
-                        W_mask.scatter_(1,ii+torch.topk(tmp, prune_n,dim=1, largest=False)[1], True)
+                W_mask = nm_mask(W_metric, prune_n, prune_m)
             else:
                 sort_res = torch.sort(W_metric, dim=-1, stable=True)
 
@@ -461,9 +588,13 @@ def prune_wanda(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0
 
             subset[name].weight.data[W_mask] = 0  ## set weights to zero 
 
-        for j in range(args.nsamples):
+        if args.quantize == "int8":
+            for name in subset:
+                quantize_linear(subset[name], wrapped_layers[name].scaler_row, args.quant_grid)
+
+        if args.propagation == "pruned":
             with torch.no_grad():
-                outs[j] = layer(inps[j].unsqueeze(0), attention_mask=attention_mask, position_embeddings=position_embeddings)[0]
+                layer_forward(layer, inps, outs, args.nsamples, args.calib_batch_size, attention_mask=attention_mask, position_embeddings=position_embeddings)
         inps, outs = outs, inps
 
     setattr(model.config, "use_cache", use_cache)
@@ -474,63 +605,13 @@ def prune_wanda(args, model, tokenizer, device=torch.device("cuda:0"), prune_n=0
 def prune_sparsegpt(args, model, tokenizer, device, prune_n=0, prune_m=0, layer_no=-1):
     ## SparseGPT code available at: https://github.com/IST-DASLab/sparsegpt/tree/f5c25005a61f96a0933ca2f95705a963585aafaa
     print('Starting ...')
-    dataloader, _ = get_loaders("c4",nsamples=args.nsamples,seed=args.seed,seqlen=2048,tokenizer=tokenizer)
+    dataloader, _ = get_loaders("c4",nsamples=args.nsamples,seed=args.seed,seqlen=2048,tokenizer=tokenizer,cache_dir=args.data_cache_dir,tokenize_workers=args.tokenize_workers)
 
+    inps, outs, attention_mask, position_embeddings = prepare_calibration_input(model, dataloader, args.nsamples, device, args.calib_batch_size, args.activation_store, args.activation_dir, args.activation_dtype)
     use_cache = getattr(model.config, "use_cache", False)
     setattr(model.config, "use_cache", False)
     layers = get_lm_layers(model)
 
-    # Determine the initial device for input preparation
-    initial_dev = device
-    if hasattr(model, 'hf_device_map'):
-        # Try different possible device map keys for embedding layer
-        possible_embed_keys = [
-            "model.language_model.embed_tokens",  # For Qwen2.5-VL and similar VLMs
-            "model.embed_tokens",  # For standard LLMs
-            "model.language_model.model.embed_tokens"  # For LLaVA-style models
-        ]
-        for key in possible_embed_keys:
-            if key in model.hf_device_map:
-                initial_dev = model.hf_device_map[key]
-                break
-
-    dtype = next(iter(model.parameters())).dtype
-    hidden_size = get_hidden_size(model)
-    inps = torch.zeros(
-        (args.nsamples, model.seqlen, hidden_size), dtype=dtype, device=initial_dev
-    )
-    cache = {'i': 0, 'attention_mask': None, "position_embeddings": None}
-
-    class Catcher(nn.Module):
-        def __init__(self, module):
-            super().__init__()
-            self.module = module
-        
-        def __getattr__(self, name):
-            try:
-                return super().__getattr__(name)
-            except AttributeError:
-                return getattr(self.module, name)
-        
-        def forward(self, inp, **kwargs):
-            inps[cache['i']] = inp
-            cache['i'] += 1
-            cache['attention_mask'] = kwargs['attention_mask']
-            cache['position_embeddings'] = kwargs['position_embeddings']
-            raise ValueError
-    layers[0] = Catcher(layers[0])
-    for batch in dataloader:
-        try:
-            model(batch[0].to(initial_dev))
-        except ValueError:
-            pass
-    layers[0] = layers[0].module
-    setattr(model.config, "use_cache", use_cache)
-
-    outs = torch.zeros_like(inps)
-    attention_mask = cache['attention_mask']
-    position_embeddings = cache['position_embeddings']
-
     print('Ready.')
 
     for i in range(len(layers)):
@@ -553,8 +634,9 @@ def prune_sparsegpt(args, model, tokenizer, device, prune_n=0, prune_m=0, layer_
             layer_dev = model.hf_device_map[layer_device_key]
             print(f"layer {i} device {layer_dev}")
             # Device transfer
-            inps = inps.to(layer_dev)
-            outs = outs.to(layer_dev)
+            if args.activation_store == "memory":
+                inps = inps.to(layer_dev)
+                outs = outs.to(layer_dev)
             if attention_mask is not None:
                 print("attention mask is not none, shape is: ", attention_mask.shape)
                 attention_mask = attention_mask.to(layer_dev)
@@ -578,8 +660,7 @@ def prune_sparsegpt(args, model, tokenizer, device, prune_n=0, prune_m=0, layer_
         for name in gpts:
             handles.append(subset[name].register_forward_hook(add_batch(name)))
 
-        for j in range(args.nsamples):
-            outs[j] = layer(inps[j].unsqueeze(0), attention_mask=attention_mask, position_embeddings=position_embeddings)[0]
+        layer_forward(layer, inps, outs, args.nsamples, args.calib_batch_size, attention_mask=attention_mask, position_embeddings=position_embeddings)
         for h in handles:
             h.remove()
 
@@ -587,11 +668,15 @@ def prune_sparsegpt(args, model, tokenizer, device, prune_n=0, prune_m=0, layer_
             print(i, name)
             print('Pruning ...')
 
+            ## fasterprune consumes H, keep its diagonal for the quantization scales
+            importance = torch.diag(gpts[name].H).clone() if args.quantize == "int8" else None
             gpts[name].fasterprune(args.sparsity_ratio, prune_n=prune_n, prune_m=prune_m, percdamp=0.01, blocksize=128)
             gpts[name].free()
+            if args.quantize == "int8":
+                quantize_linear(subset[name], importance, args.quant_grid)
 
-        for j in range(args.nsamples):
-            outs[j] = layer(inps[j].unsqueeze(0), attention_mask=None, position_embeddings=position_embeddings)[0]
+        if args.propagation == "pruned":
+            layer_forward(layer, inps, outs, args.nsamples, args.calib_batch_size, attention_mask=None, position_embeddings=position_embeddings)
 
         layers[i] = layer 
         setattr(model.config, "use_cache", use_cache)
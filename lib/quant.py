@@ -0,0 +1,55 @@
+#quant.py
+import torch
+
+
+def quantize_rows(W, importance=None, grid=20, max_shrink=0.5, tile_rows=1024):
+    """
+    Symmetric int8 fake quantization of W in place with one scale per output channel.
+
+    The clipping range of every row is searched over grid candidates from its absmax down to
+    (1 - max_shrink) * absmax, keeping the one with the lowest importance-weighted squared error
+    sum_j importance_j * (w_ij - q_ij)^2. With importance = E[x_j^2] (WrappedGPT.scaler_row, or the
+    diagonal of the SparseGPT Hessian) this is the expected output error of the row under a
+    diagonal input approximation. Pruned weights quantize to exactly zero, so the mask is kept.
+
+    Args:
+        W (torch.Tensor): Weight of shape (rows, columns), overwritten with its dequantized values.
+        importance (torch.Tensor): Per-input-column weights of the error, uniform when None.
+        grid (int): Number of clipping candidates.
+        max_shrink (float): Largest fraction of the absmax that may be clipped away.
+        tile_rows (int): Rows processed at a time, bounds the float32 working copy.
+
+    Returns:
+        torch.Tensor: float32 scales of shape (rows,); W equals int8 codes times scale.
+    """
+    qmax = 127
+    rows, columns = W.shape
+    if importance is None:
+        importance = torch.ones(columns, device=W.device)
+    importance = importance.float().to(W.device).reshape((1, -1))
+    scales = torch.empty(rows, dtype=torch.float32, device=W.device)
+    for r0 in range(0, rows, tile_rows):
+        r1 = min(r0 + tile_rows, rows)
+        w = W[r0:r1].float()
+        absmax = w.abs().amax(dim=1).clamp_(min=1e-8)
+        best_err = torch.full((r1 - r0,), float("inf"), device=W.device)
+        best_scale = absmax / qmax
+        for g in range(grid):
+            scale = absmax * (1 - max_shrink * g / grid) / qmax
+            q = (w / scale.reshape((-1,1))).round_().clamp_(-qmax, qmax) * scale.reshape((-1,1))
+            err = ((q - w) ** 2 * importance).sum(dim=1)
+            better = err < best_err
+            best_err = torch.where(better, err, best_err)
+            best_scale = torch.where(better, scale, best_scale)
+        W[r0:r1] = ((w / best_scale.reshape((-1,1))).round_().clamp_(-qmax, qmax) * best_scale.reshape((-1,1))).to(W.dtype)
+        scales[r0:r1] = best_scale
+    return scales
+
+
+def quantize_linear(linear, importance=None, grid=20):
+    """
+    Fake-quantize a pruned Linear with quantize_rows and keep its scales as the non-persistent
+    weight_scale buffer, which save_sparse uses to export int8 codes.
+    """
+    scales = quantize_rows(linear.weight.data, importance, grid)
+    linear.register_buffer("weight_scale", scales, persistent=False)
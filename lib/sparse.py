@@ -0,0 +1,278 @@
+#sparse.py
+import json
+import os
+import torch
+import torch.nn as nn
+from safetensors import safe_open
+from safetensors.torch import save_file
+from .prune import find_layers, get_lm_layers
+
+SPARSE_WEIGHTS_NAME = "model.sparse.safetensors"
+
+
+def pack_nm(weight, prune_n, prune_m):
+    """
+    Pack an N:M sparse weight into the m - n kept values of every group of m input columns.
+
+    Args:
+        weight (torch.Tensor): Weight of shape (rows, columns) with at most m - n non-zeros per group.
+        prune_n (int): Number of pruned weights in each group.
+        prune_m (int): Group size.
+
+    Returns:
+        tuple: values of shape (rows, columns // m * (m - n)) and their uint8 offsets within the group.
+    """
+    rows, columns = weight.shape
+    if columns % prune_m != 0:
+        raise ValueError(f"{columns} input features are not a multiple of {prune_m}")
+    kept = prune_m - prune_n
+    groups = weight.reshape(rows, columns // prune_m, prune_m)
+    nonzero = groups != 0
+    if (nonzero.sum(dim=-1) > kept).any():
+        raise ValueError(f"weight is not {prune_n}:{prune_m} sparse")
+    ## non-zeros first, the lowest offsets filling up groups that have fewer than m - n of them
+    offsets = torch.sort(nonzero.to(torch.int8), dim=-1, descending=True, stable=True)[1][..., :kept]
+    offsets = torch.sort(offsets, dim=-1)[0]
+    values = groups.gather(-1, offsets)
+    return values.reshape(rows, -1), offsets.to(torch.uint8).reshape(rows, -1)
+
+
+def unpack_nm(values, offsets, prune_n, prune_m):
+    """
+    Inverse of pack_nm.
+    """
+    rows = values.shape[0]
+    kept = prune_m - prune_n
+    ngroups = values.shape[1] // kept
+    weight = torch.zeros((rows, ngroups, prune_m), dtype=values.dtype, device=values.device)
+    weight.scatter_(-1, offsets.long().reshape(rows, ngroups, kept), values.reshape(rows, ngroups, kept))
+    return weight.reshape(rows, ngroups * prune_m)
+
+
+def pack_bitmask(weight):
+    """
+    Store the non-zeros of a weight as a bitmask (8 weights per uint8, row-major) and a flat values tensor.
+    """
+    mask = (weight != 0).flatten()
+    pad = (-mask.numel()) % 8
+    bits = torch.cat([mask, mask.new_zeros(pad)]).reshape(-1, 8).to(torch.uint8)
+    bitmask = (bits << torch.arange(7, -1, -1, dtype=torch.uint8, device=bits.device)).sum(dim=1, dtype=torch.uint8)
+    return bitmask, weight.flatten()[mask]
+
+
+def unpack_bitmask(bitmask, values, shape):
+    """
+    Inverse of pack_bitmask.
+    """
+    numel = shape[0] * shape[1]
+    bits = (bitmask.unsqueeze(-1) >> torch.arange(7, -1, -1, dtype=torch.uint8, device=bitmask.device)) & 1
+    mask = bits.flatten()[:numel].bool()
+    weight = torch.zeros(numel, dtype=values.dtype, device=values.device)
+    weight[mask] = values
+    return weight.reshape(shape)
+
+
+def csr_int32(crow_indices, col_indices, values, size):
+    ## int32 indices halve the index memory of the default int64 CSR layout
+    return torch.sparse_csr_tensor(crow_indices.to(torch.int32), col_indices.to(torch.int32), values, size=size)
+
+
+def nm_to_csr(values, offsets, prune_n, prune_m, in_features):
+    """
+    CSR weight of the pack_nm layout: every row holds in_features // m * (m - n) entries.
+    """
+    rows, nnz = values.shape
+    kept = prune_m - prune_n
+    group_start = torch.arange(nnz // kept, device=values.device) * prune_m
+    col_indices = group_start.repeat_interleave(kept) + offsets.long()
+    crow_indices = torch.arange(rows + 1, device=values.device) * nnz
+    return csr_int32(crow_indices, col_indices.flatten(), values.flatten(), (rows, in_features))
+
+
+class CSRLinear(nn.Module):
+    """
+    Linear layer with its pruned weight in CSR format, for unstructured sparsity.
+    """
+
+    def __init__(self, weight, bias=None, dtype=None):
+        super().__init__()
+        dtype = dtype or weight.dtype
+        self.out_features, self.in_features = weight.shape
+        csr = weight.detach().to(dtype).to_sparse_csr()
+        self.register_buffer("weight", csr_int32(csr.crow_indices(), csr.col_indices(), csr.values(), tuple(weight.shape)))
+        self.register_buffer("bias", None if bias is None else bias.detach().to(dtype))
+
+    @classmethod
+    def from_linear(cls, linear, dtype=None):
+        return cls(linear.weight.data, linear.bias, dtype)
+
+    def forward(self, x):
+        shape, dtype = x.shape, x.dtype
+        x = x.reshape(-1, shape[-1]).to(self.weight.dtype)
+        out = torch.mm(self.weight, x.t()).t()
+        if self.bias is not None:
+            out = out + self.bias
+        return out.reshape(*shape[:-1], self.out_features).to(dtype)
+
+
+class NMLinear(CSRLinear):
+    """
+    Linear layer for N:M sparsity. The weight is kept and multiplied as plain CSR (nm_to_csr), in
+    which every row has the same number of entries; the pack_nm layout (values plus uint8 offsets in
+    the group) is the on-disk format of save_sparse and is only used to build that CSR weight.
+    """
+
+    def __init__(self, values, offsets, prune_n, prune_m, in_features, bias=None):
+        nn.Module.__init__(self)
+        self.out_features, self.in_features = values.shape[0], in_features
+        self.prune_n, self.prune_m = prune_n, prune_m
+        self.register_buffer("weight", nm_to_csr(values, offsets, prune_n, prune_m, in_features))
+        self.register_buffer("bias", bias)
+
+    @classmethod
+    def from_linear(cls, linear, prune_n, prune_m, dtype=None):
+        dtype = dtype or linear.weight.dtype
+        values, offsets = pack_nm(linear.weight.data.to(dtype), prune_n, prune_m)
+        bias = None if linear.bias is None else linear.bias.detach().to(dtype)
+        return cls(values, offsets, prune_n, prune_m, linear.in_features, bias)
+
+
+def set_module(root, name, module):
+    parent, _, child = name.rpartition('.')
+    setattr(root.get_submodule(parent) if parent else root, child, module)
+
+
+def sparsify_model(model, sparsity_type="unstructured", dtype=None):
+    """
+    Replace the Linear layers of every decoder layer with CSRLinear ("unstructured") or
+    NMLinear ("n:m") modules holding the same weights.
+    """
+    prune_n, prune_m = 0, 0
+    if sparsity_type != "unstructured":
+        prune_n, prune_m = map(int, sparsity_type.split(":"))
+    for layer in get_lm_layers(model):
+        for name, linear in find_layers(layer).items():
+            if prune_n == 0:
+                sparse = CSRLinear.from_linear(linear, dtype)
+            else:
+                sparse = NMLinear.from_linear(linear, prune_n, prune_m, dtype)
+            set_module(layer, name, sparse)
+    return model
+
+
+def save_sparse(model, path, sparsity_type="unstructured"):
+    """
+    Write a pruned model as its config plus one safetensors file in which the Linear weights of the
+    decoder layers are compressed: packed values and offsets (pack_nm) for n:m sparsity, a bitmask
+    and the non-zero values (pack_bitmask) otherwise. Linears quantized by quantize_linear store
+    int8 codes plus their per-row scales. All other tensors are stored dense.
+    """
+    prune_n, prune_m = 0, 0
+    if sparsity_type != "unstructured":
+        prune_n, prune_m = map(int, sparsity_type.split(":"))
+    linear_names, scales = set(), {}
+    layer_linears = {id(m) for layer in get_lm_layers(model) for m in find_layers(layer).values()}
+    for name, module in model.named_modules():
+        if isinstance(module, nn.Linear) and id(module) in layer_linears:
+            linear_names.add(f"{name}.weight")
+            if getattr(module, "weight_scale", None) is not None:
+                scales[f"{name}.weight"] = module.weight_scale.cpu()
+
+    tensors, formats, shapes, seen = {}, {}, {}, set()
+    for key, tensor in model.state_dict().items():
+        ## tied weights (e.g. lm_head and embed_tokens) are written once and re-tied on load
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        tensor = tensor.detach().cpu()
+        if key not in linear_names or (key not in scales and (tensor != 0).float().mean() > 15 / 16):
+            tensors[key] = tensor.contiguous()
+            continue
+        shapes[key] = list(tensor.shape)
+        if key in scales:
+            ## weights quantized by quantize_linear are exact multiples of their row scale
+            tensors[f"{key}.scale"] = scales[key]
+            tensor = (tensor.float() / scales[key].reshape((-1,1))).round_().to(torch.int8)
+        try:
+            if prune_n == 0:
+                raise ValueError
+            tensors[f"{key}.values"], tensors[f"{key}.offsets"] = pack_nm(tensor, prune_n, prune_m)
+            formats[key] = sparsity_type
+        except ValueError:
+            ## unstructured, or a layer that was left out of n:m pruning
+            tensors[f"{key}.bitmask"], tensors[f"{key}.values"] = pack_bitmask(tensor)
+            formats[key] = "bitmask"
+    os.makedirs(path, exist_ok=True)
+    model.config.save_pretrained(path)
+    ## the class is recorded so that VLMs (Llava, Qwen2.5-VL) are rebuilt as themselves, not as a causal LM
+    metadata = {"formats": json.dumps(formats), "shapes": json.dumps(shapes), "model_class": type(model).__name__}
+    save_file(tensors, os.path.join(path, SPARSE_WEIGHTS_NAME), metadata=metadata)
+
+
+def load_sparse(path, dtype=torch.float16, sparse_modules=False):
+    """
+    Rebuild a model written by save_sparse, as the transformers class recorded in its metadata
+    (LlavaForConditionalGeneration, Qwen2.5-VL, or a causal LM).
+
+    Args:
+        path (str): Directory of the sparse checkpoint.
+        dtype (torch.dtype): dtype of the model.
+        sparse_modules (bool): Build CSRLinear / NMLinear modules straight from the compressed weights
+            instead of decompressing them into dense nn.Linear weights.
+
+    Returns:
+        The model, on the CPU.
+    """
+    import transformers
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    with safe_open(os.path.join(path, SPARSE_WEIGHTS_NAME), framework="pt", device="cpu") as f:
+        metadata = f.metadata()
+    config = AutoConfig.from_pretrained(path, trust_remote_code=True)
+    model_class = getattr(transformers, metadata.get("model_class", ""), None)
+    ## parameters stay on the meta device until the checkpoint tensors are assigned
+    with init_empty_weights(include_buffers=False):
+        if model_class is not None:
+            model = model_class._from_config(config, torch_dtype=dtype)
+        else:
+            ## remote-code models, built the way get_llm loads them
+            model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype, trust_remote_code=True)
+
+    state_dict = {}
+    with safe_open(os.path.join(path, SPARSE_WEIGHTS_NAME), framework="pt", device="cpu") as f:
+        formats, shapes = json.loads(metadata["formats"]), json.loads(metadata["shapes"])
+        keys = set(f.keys())
+        for key in keys:
+            if key.rsplit(".", 1)[0] not in formats:
+                tensor = f.get_tensor(key)
+                state_dict[key] = tensor.to(dtype) if tensor.is_floating_point() else tensor
+        for key, fmt in formats.items():
+            module_name = key.rsplit(".", 1)[0]
+            bias = state_dict.pop(f"{module_name}.bias", None)
+            ## int8 codes are dequantized with their row scales
+            scale = f.get_tensor(f"{key}.scale").reshape((-1,1)) if f"{key}.scale" in keys else None
+            if fmt == "bitmask":
+                weight = unpack_bitmask(f.get_tensor(f"{key}.bitmask"), f.get_tensor(f"{key}.values"), shapes[key])
+                weight = (weight if scale is None else weight.float() * scale).to(dtype)
+                if sparse_modules:
+                    set_module(model, module_name, CSRLinear(weight, bias, dtype))
+                    continue
+                state_dict[key] = weight
+            else:
+                prune_n, prune_m = map(int, fmt.split(":"))
+                values, offsets = f.get_tensor(f"{key}.values"), f.get_tensor(f"{key}.offsets")
+                values = (values if scale is None else values.float() * scale).to(dtype)
+                if sparse_modules:
+                    set_module(model, module_name, NMLinear(values, offsets, prune_n, prune_m, shapes[key][1], bias))
+                    continue
+                state_dict[key] = unpack_nm(values, offsets, prune_n, prune_m)
+            if bias is not None:
+                state_dict[f"{module_name}.bias"] = bias
+
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    missing = [name for name, p in model.named_parameters() if p.device.type == "meta"]
+    if missing:
+        raise ValueError(f"{path} has no tensors for {missing}")
+    return model
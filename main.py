@@ -7,6 +7,7 @@ from importlib.metadata import version
 
 from lib.prune import prune_wanda, prune_magnitude, prune_sparsegpt, check_sparsity, find_layers, prune_gradient, prune_gblm
 from lib.eval import eval_ppl
+from lib.sparse import save_sparse
 
 print('torch', version('torch'))
 print('transformers', version('transformers'))
@@ -65,23 +66,48 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', type=str, help='LLaMA model')
     parser.add_argument('--gradient_path', default=None,type=str, help='gradient path')
+    parser.add_argument('--gblm_gradient', type=str, default="file", choices=["file", "local"], help='gblm gradients from --gradient_path, or computed per decoder layer from a local reconstruction loss')
+    parser.add_argument('--local_grad_norm', type=str, default="l1", choices=["l1", "l2"], help='Accumulation of the per-sample local gradients.')
+    parser.add_argument('--local_grad_scale', type=float, default=100, help='Scale of the local gradients, as --scale in gradient_computation.py.')
     parser.add_argument('--grad_norm', type=str, default="none", choices=["none", "accumulation_norm", "2-norm-sample-dim"])
     parser.add_argument('--seed', type=int, default=0, help='Seed for sampling the calibration data.')
     parser.add_argument('--nsamples', type=int, default=128, help='Number of calibration samples.')
+    parser.add_argument('--calib_batch_size', type=int, default=1, help='Micro-batch size for the calibration forward passes.')
+    parser.add_argument('--activation_store', type=str, default="memory", choices=["memory", "mmap"], help='Keep calibration activations on the compute device or in memory-mapped files.')
+    parser.add_argument('--activation_dir', type=str, default=None, help='Directory for memory-mapped calibration activations (system temp dir by default).')
+    parser.add_argument('--activation_dtype', type=str, default="native", choices=["native", "int8", "fp8"], help='Storage format of the calibration activations, 8-bit formats use a per-token scale.')
+    parser.add_argument('--propagation', type=str, default="pruned", choices=["pruned", "dense"], help='Next-layer calibration inputs: re-forward through the pruned layer, or reuse the dense outputs of the statistics pass.')
     parser.add_argument('--seq_length', type=int, default=2048, help='Sequence length of the input.')
     parser.add_argument('--sparsity_ratio', type=float, default=0, help='Sparsity level')
     parser.add_argument('--layer_no', type=int, default=-1, help='Sparsity level')
     parser.add_argument("--sparsity_type", type=str, choices=["unstructured", "4:8", "2:4"])
     parser.add_argument("--prune_method", type=str, choices=["magnitude", "wanda", "sparsegpt","gradient", "gblm"])
     parser.add_argument("--cache_dir", default="./llm_weights", type=str )
+    parser.add_argument('--data_cache_dir', type=str, default=None, help='Directory of the tokenized calibration/evaluation cache (default: $GBLM_DATA_CACHE, no caching if unset).')
     parser.add_argument('--use_variant', action="store_true", help="whether to use the wanda variant described in the appendix")
+    parser.add_argument('--magnitude_scope', type=str, default="layer", choices=["layer", "global"], help='Magnitude pruning threshold per Linear layer or over all decoder layers.')
+    parser.add_argument('--use_fast_tokenizer', action='store_true', help='Load the fast (Rust) tokenizer; its token ids can differ from the slow one, so calibration samples change.')
+    parser.add_argument('--tokenize_workers', type=int, default=None, help='Processes for batched c4 tokenization with a slow tokenizer (default: min(8, cpu count)).')
+    parser.add_argument('--tile_rows', type=int, default=0, help='Rows per tile for bounded-memory unstructured wanda/gblm pruning (0 disables tiling).')
+    parser.add_argument('--eval_datasets', type=str, nargs='+', default=['wikitext2'], choices=['wikitext2', 'c4'], help='Datasets to report perplexity on (c4 uses its validation split).')
+    parser.add_argument('--eval_batch_size', type=int, default=1, help='Number of seqlen windows per forward pass during perplexity evaluation.')
+    parser.add_argument('--eval_vocab_chunk', type=int, default=0, help='Compute the evaluation loss from the final hidden states against lm_head in chunks of this many vocabulary rows (0 materializes the full logits).')
+    parser.add_argument('--eval_mode', type=str, default='full', choices=['full', 'layerwise'], help='full runs the whole model per batch; layerwise streams the test set through one decoder layer at a time (buffers follow --activation_store).')
+    parser.add_argument('--eval_tolerance', type=float, default=0, help='Stop evaluating once the 95%% interval on perplexity is narrower than this fraction of it, visiting windows in a --seed order (0 evaluates every window).')
+    parser.add_argument('--quantize', type=str, default='none', choices=['none', 'int8'], help='Quantize the surviving weights of every pruned Linear to int8 with per-channel scales chosen from the calibration statistics (wanda, gblm and sparsegpt).')
+    parser.add_argument('--quant_grid', type=int, default=20, help='Number of clipping ratios searched per output channel for --quantize.')
     parser.add_argument('--save', type=str, default=None, help='Path to save results.')
     parser.add_argument('--save_model', type=str, default=None, help='Path to save the pruned model.')
+    parser.add_argument('--save_model_format', type=str, default='dense', choices=['dense', 'sparse'], help='dense: save_pretrained; sparse: compressed decoder Linear weights, int8 codes with --quantize (lib/sparse.py, load with load_sparse).')
     parser.add_argument('--grad_exponent', action='store_true', help='Use gradient of exponent')
     parser.add_argument('--gradient_inv', action='store_true', help='Use inverse of gradient')
     args = parser.parse_args()
+    if args.gblm_gradient == "local" and args.gradient_inv:
+        parser.error("--gradient_inv divides by the gradient, local gradients are zero or near zero in the first layers")
+    if args.quantize != "none" and args.prune_method not in ("wanda", "gblm", "sparsegpt"):
+        parser.error("--quantize needs the calibration statistics of wanda, gblm or sparsegpt")
     print(f"Working on model: {args.model}")
-    print(f"working on method {args.prune_method}, grad norm {args.grad_norm}, gradient path {args.gradient_path}, inverse enabled {args.gradient_inv}, sparsity type {args.sparsity_type}, seq lenght {args.seq_length}")
+    print(f"working on method {args.prune_method}, grad norm {args.grad_norm}, gradient path {args.gradient_path}, inverse enabled {args.gradient_inv}, sparsity type {args.sparsity_type}, seq lenght {args.seq_length}, propagation {args.propagation}, activation dtype {args.activation_dtype}, quantize {args.quantize}")
 
     # Setting seeds for reproducibility
     np.random.seed(args.seed)
@@ -103,21 +129,21 @@ def main():
         try:
             # Qwen2.5-VL uses a subfolder for the language model
             text_tokenizer = AutoTokenizer.from_pretrained(
-                os.path.join(args.model, "language_model"), use_fast=False
+                os.path.join(args.model, "language_model"), use_fast=args.use_fast_tokenizer
             )
         except Exception:
             # Fallback: try loading from the base model
-            text_tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=False)
+            text_tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=args.use_fast_tokenizer)
         tokenizer = text_tokenizer
     else:
         # Patch: For LLaVA, use LlamaTokenizer (or AutoTokenizer fallback)
         if "llava" in args.model.lower():
             try:
-                tokenizer = LlamaTokenizer.from_pretrained(args.model, use_fast=False)
+                tokenizer = LlamaTokenizer.from_pretrained(args.model, use_fast=args.use_fast_tokenizer)
             except Exception:
-                tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=False)
+                tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=args.use_fast_tokenizer)
         else:
-            tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=False)
+            tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=args.use_fast_tokenizer)
 
     device = torch.device("cuda:0")
     if "30b" in args.model or "65b" in args.model or "70b" in args.model: 
@@ -149,18 +175,27 @@ def main():
     print(f"sparsity sanity check {sparsity_ratio:.4f}")
     print("*"*30)
     ################################################################
-    ppl = eval_ppl(model, tokenizer, device)
-    print(f"ppl on wikitext {ppl}")
+    ppls = eval_ppl(model, tokenizer, device, cache_dir=args.data_cache_dir, datasets=args.eval_datasets, bs=args.eval_batch_size, vocab_chunk=args.eval_vocab_chunk, mode=args.eval_mode, store=args.activation_store, store_dir=args.activation_dir, tolerance=args.eval_tolerance, seed=args.seed)
+    for dataset, result in ppls.items():
+        print(f"ppl on {dataset} {result['ppl']} ({result['tokens']} tokens)")
 
     if not os.path.exists(args.save):
         os.makedirs(args.save)
     save_filepath = os.path.join(args.save, "log.txt")
     with open(save_filepath, "w") as f:
-        print("actual_sparsity\tppl", file=f, flush=True)
-        print(f"{sparsity_ratio:.4f}\t{ppl:.4f}", file=f, flush=True)
+        ## wikitext2 keeps the plain "ppl" column name
+        ppl_columns = "\t".join("ppl" if dataset == "wikitext2" else f"ppl_{dataset}" for dataset in ppls)
+        ppl_values = "\t".join(f"{result['ppl']:.4f}" for result in ppls.values())
+        token_columns = "\t".join("eval_tokens" if dataset == "wikitext2" else f"eval_tokens_{dataset}" for dataset in ppls)
+        token_values = "\t".join(str(result['tokens']) for result in ppls.values())
+        print(f"actual_sparsity\t{ppl_columns}\tpropagation\tactivation_dtype\t{token_columns}\tquantize", file=f, flush=True)
+        print(f"{sparsity_ratio:.4f}\t{ppl_values}\t{args.propagation}\t{args.activation_dtype}\t{token_values}\t{args.quantize}", file=f, flush=True)
     
     if args.save_model:
-        model.save_pretrained(args.save_model)
+        if args.save_model_format == "sparse":
+            save_sparse(model, args.save_model, args.sparsity_type)
+        else:
+            model.save_pretrained(args.save_model)
         tokenizer.save_pretrained(args.save_model)
     print("*"*30)
 
@@ -0,0 +1,22 @@
+# Perplexity cost of compressed calibration activations on a small model:
+# prune with wanda once per activation storage format and compare against native fp16 storage.
+MODEL=Qwen/Qwen2.5-0.5B
+OUT=out/qwen_2_5_0_5b/unstructured/wanda_activation_dtype
+
+for DTYPE in native int8 fp8; do
+CUDA_VISIBLE_DEVICES=0 python main.py \
+    --model $MODEL \
+    --prune_method wanda \
+    --nsamples 128 \
+    --seed 0 \
+    --sparsity_ratio 0.5 \
+    --sparsity_type unstructured \
+    --activation_dtype $DTYPE \
+    --save $OUT/$DTYPE/
+done
+
+BASE=$(awk 'NR==2 {print $2}' $OUT/native/log.txt)
+echo -e "activation_dtype\tppl\tdelta_vs_native"
+for DTYPE in native int8 fp8; do
+    awk -v base=$BASE -v dtype=$DTYPE 'NR==2 {printf "%s\t%s\t%+.4f\n", dtype, $2, $2 - base}' $OUT/$DTYPE/log.txt
+done